@@ -0,0 +1,368 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2012 Adrian Musceac
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os, sys, math, time, random
+import json, shutil, tempfile, optparse, resource
+import multiprocessing, cStringIO
+
+import groundnet
+
+__doc__="""Benchmark for groundnet.py on a synthetic airport database
+
+Generates apt.dat and apt850.dat files with a number of airports which fit the
+default layout and a number which do not, plus a fake scenery Airports tree, then
+times every stage of the generator on its own:
+
+index     -> streaming pass over the data file which classifies the airports
+scan      -> scenery tree scan for airports missing a ground network, cold cache
+geometry  -> Parser reading the records and computing the coordinates
+validate  -> laying out the networks and checking them
+serialize -> writing the groundnet xml to memory
+write     -> writing the groundnet files to disk
+
+Every corpus size runs in its own process, so the peak RSS reported is the one of
+that size. Results can be saved as a baseline and later runs compared against it.
+
+Usage:
+benchmark.py 				#-> runs the default sizes
+benchmark.py --sizes 1000,10000 	#-> runs the given numbers of default airports
+benchmark.py --save-baseline FILE 	#-> stores the results
+benchmark.py --baseline FILE 		#-> compares against stored results, exits with 1 on regressions
+benchmark.py --generate DIR --sizes N 	#-> only writes a corpus of N default airports to DIR
+"""
+
+STAGES=('index','scan','geometry','validate','serialize','write')
+
+
+########## synthetic corpus #############
+
+def icao_name(i):
+	name=''
+	for k in range(4):
+		name=chr(65+i%26)+name
+		i//=26
+	return name
+
+
+# point m meters away from lat,lon on heading, with positive east longitudes
+def offset(lat,lon,heading,m):
+	d=m/6371000.0
+	lat_r=math.radians(lat)
+	heading=math.radians(heading)
+	lat2=math.asin(math.sin(lat_r)*math.cos(d)+math.cos(lat_r)*math.sin(d)*math.cos(heading))
+	lon2=math.radians(lon)+math.atan2(math.sin(heading)*math.sin(d)*math.cos(lat_r),math.cos(d)-math.sin(lat_r)*math.sin(lat2))
+	return math.degrees(lat2),math.degrees(lon2)
+
+
+def frequency_rows(rnd):
+	rows=[]
+	for code,name in ((50,'ATIS'),(51,'UNICOM'),(53,'GND'),(54,'TWR')):
+		if rnd.random()<0.7:
+			rows.append('%d %d %s' % (code,rnd.randint(11800,13600),name))
+	return rows
+
+
+# runway with a parallel taxiway and 3 connectors, missing connectors when not default
+def airport_810(rnd,icao,default):
+	lat=rnd.uniform(-60,60)
+	lon=rnd.uniform(-179,179)
+	heading=rnd.uniform(0,179)
+	length=rnd.choice([2000,2500,3200,4000])
+	row='10  %10.6f %11.6f %s %6.2f %6d 0000.0000 0000.0000 %4d 111111 02 0 0 0.25 0 0000.0000'
+	lines=['1 %d 0 0 %s %s field' % (rnd.randint(0,3000),icao,icao)]
+	lines.append(row % (lat,lon,'%02dx' % (int(heading/10)%36),heading,length,100))
+	taxiways=[]
+	for f in (-1,0,1):
+		c=offset(lat,lon,heading,f*length*groundnet.FEET_TO_METER/2)
+		c=offset(c[0],c[1],heading+90,75)
+		taxiways.append(row % (c[0],c[1],'xxx',(heading+90)%360,490,50))
+	c=offset(lat,lon,heading+90,150)
+	taxiways.append(row % (c[0],c[1],'xxx',heading,length,50))
+	if not default:
+		taxiways=taxiways[:rnd.randint(1,3)]
+	return lines+taxiways+frequency_rows(rnd)
+
+
+# runway, one pavement with 14 nodes and 4 bezier nodes and 3 linear features,
+# two bezier nodes are missing when not default
+def airport_850(rnd,icao,default):
+	lat=rnd.uniform(-60,60)
+	lon=rnd.uniform(-179,179)
+	heading=rnd.uniform(0,359)
+	lines=['1 %d 0 0 %s %s field' % (rnd.randint(0,3000),icao,icao)]
+	a=offset(lat,lon,heading,600)
+	b=offset(lat,lon,heading+180,600)
+	lines.append('100 30.00 1 0 0.25 0 0 0 09 %.8f %.8f 0 0 1 0 0 0 27 %.8f %.8f 0 0 1 0 0 0' % (a[0],a[1],b[0],b[1]))
+	lines.append('110 1 0.25 %.2f Taxiway' % heading)
+	points=[offset(lat,lon,rnd.uniform(0,360),rnd.uniform(50,700)) for k in range(22)]
+	codes=['111']*8+['112']*4+['113']
+	if not default:
+		codes=codes[:8]+codes[10:]
+	p=0
+	for code in codes:
+		if code=='112':
+			lines.append('112 %.8f %.8f %.8f %.8f' % (points[p]+(points[p][0]+0.0001,points[p][1])))
+		else:
+			lines.append('%s %.8f %.8f' % ((code,)+points[p]))
+		p+=1
+	for k in range(3):
+		lines.append('120 Line %d' % k)
+		for code in ('111','111','115'):
+			lines.append('%s %.8f %.8f 51' % ((code,)+points[p%22]))
+			p+=1
+	return lines+frequency_rows(rnd)
+
+
+# Writes a data file with the given numbers of default and other airports, returns the icao codes of the default ones.
+# The 810 and 850 files use different codes.
+def generate_apt(path,version,eligible,ineligible,seed=1):
+	rnd=random.Random(seed)
+	if version==850:
+		airport=airport_850
+	else:
+		airport=airport_810
+	order=range(eligible+ineligible)
+	rnd.shuffle(order)
+	names=[]
+	fw=open(path,'wb')
+	fw.write('I\n%d Version - synthetic groundnet benchmark data\n\n' % version)
+	for i in range(eligible+ineligible):
+		icao=icao_name((order[i]*2+version/850)*3+5)
+		default=i<eligible
+		if default:
+			names.append(icao)
+		fw.write('\n'.join(airport(rnd,icao,default)))
+		fw.write('\n\n')
+	fw.write('99\n')
+	fw.close()
+	return names
+
+
+# Scenery tree with a file for every airport, a fifth of them already have a ground network
+def generate_scenery(root,names,seed=3):
+	rnd=random.Random(seed)
+	for icao in names:
+		dir_path=os.path.join(root,icao[0],icao[1],icao[2])
+		if not os.path.isdir(dir_path):
+			os.makedirs(dir_path)
+		open(os.path.join(dir_path,icao+'.threshold.xml'),'wb').write('<?xml version="1.0"?>\n<PropertyList/>\n')
+		if rnd.random()<0.2:
+			open(os.path.join(dir_path,icao+'.groundnet.xml'),'wb').write('<?xml version="1.0"?>\n<groundnet/>\n')
+
+
+def generate_corpus(path,eligible,ineligible):
+	if not os.path.isdir(path):
+		os.makedirs(path)
+	names=generate_apt(os.path.join(path,'apt.dat'),810,eligible,ineligible)
+	names+=generate_apt(os.path.join(path,'apt850.dat'),850,eligible,ineligible,seed=2)
+	generate_scenery(os.path.join(path,'Airports'),names)
+
+
+########## stages #############
+
+def timed(results,stage,count,func,*args):
+	start=time.time()
+	value=func(*args)
+	seconds=time.time()-start
+	rate=0.0
+	if seconds>0:
+		rate=count/seconds
+	results[stage]={'seconds':seconds,'airports':count,'airports_per_sec':rate}
+	return value
+
+
+def read_parsers(index,version):
+	parsers=[]
+	for a in index.eligible:
+		pthread=groundnet.Parser(a,True,60,50,index.read_record(a),version)
+		pthread.read()
+		parsers.append(pthread)
+	groundnet.compute_geometry(parsers,60,50)
+	return parsers
+
+
+def validate(parsers):
+	for pthread in parsers:
+		pthread.layout()
+	return groundnet.validate_networks(parsers)
+
+
+def serialize(parsers,version):
+	for pthread in parsers:
+		out=cStringIO.StringIO()
+		if version==850:
+			pthread.write_airport_850(out)
+		else:
+			pthread.write_airport(out)
+
+
+def write(parsers):
+	for pthread in parsers:
+		pthread.build()
+
+
+def scan(root):
+	gn=groundnet.Groundnet()
+	gn.scenery_airports=root
+	return gn.missing_network
+
+
+# Largest difference between the numpy and the scalar geometry, None without numpy
+def geometry_difference(parsers):
+	if groundnet.numpy==None:
+		return None
+	taxiways=[]
+	origins=[]
+	for p in parsers:
+		taxiways.extend(p.taxiways)
+		origins.extend(p.park_origins)
+	args=([t.lat for t in taxiways],[t.lon for t in taxiways],[t.heading for t in taxiways],[t.length/2 for t in taxiways])
+	park_args=([o.lat for o in origins],[o.lon for o in origins],[o.heading for o in origins],60,50)
+	ends=groundnet.taxiway_endpoints(*args)
+	parking=groundnet.parking_positions(*park_args)
+	numpy=groundnet.numpy
+	groundnet.numpy=None
+	try:
+		scalar_ends=groundnet.taxiway_endpoints(*args)
+		scalar_parking=groundnet.parking_positions(*park_args)
+	finally:
+		groundnet.numpy=numpy
+	diff=0.0
+	for a,b in zip(ends,scalar_ends):
+		diff=max([diff]+[abs(x-y) for x,y in zip(a,b)])
+	for a,b in zip(parking,scalar_parking):
+		diff=max(diff,abs(a[1]-b[1]))
+		for p,q in zip(a[0],b[0]):
+			diff=max([diff]+[abs(x-y) for x,y in zip(p,q)])
+	return diff
+
+
+def run_size(size,ineligible,queue):
+	groundnet.load_numpy()
+	work_dir=tempfile.mkdtemp(prefix='groundnet-bench-')
+	cwd=os.getcwd()
+	try:
+		generate_corpus(work_dir,size,ineligible)
+		os.chdir(work_dir)
+		results={}
+		for version,name in ((810,'apt.dat'),(850,'apt850.dat')):
+			stages={}
+			index=groundnet.AptIndex(os.path.join(work_dir,name),version)
+			timed(stages,'index',size+ineligible,index.build)
+			parsers=timed(stages,'geometry',size,read_parsers,index,version)
+			problems=timed(stages,'validate',size,validate,parsers)
+			stages['validate']['failed']=len([p for p in problems if len(p)>0])
+			timed(stages,'serialize',size,serialize,parsers,version)
+			timed(stages,'write',size,write,parsers)
+			stages['geometry']['max_difference']=geometry_difference(parsers)
+			results[str(version)]=stages
+		missing=timed(results,'scan',2*size,scan,os.path.join(work_dir,'Airports'))
+		results['scan']['missing']=len(missing)
+		results['peak_rss_kb']=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+		queue.put(results)
+	finally:
+		os.chdir(cwd)
+		shutil.rmtree(work_dir,True)
+
+
+def run(sizes,ineligible_ratio):
+	results={}
+	for size in sizes:
+		queue=multiprocessing.Queue()
+		child=multiprocessing.Process(target=run_size,args=(size,int(size*ineligible_ratio),queue))
+		child.start()
+		results[str(size)]=queue.get()
+		child.join()
+	return results
+
+
+def report(results):
+	print '%8s %6s %-10s %10s %14s' % ('size','format','stage','seconds','airports/sec')
+	for size in sorted(results,key=int):
+		for version in ('810','850'):
+			for stage in STAGES:
+				if stage in results[size][version]:
+					r=results[size][version][stage]
+					print '%8s %6s %-10s %10.3f %14.0f' % (size,version,stage,r['seconds'],r['airports_per_sec'])
+		r=results[size]['scan']
+		print '%8s %6s %-10s %10.3f %14.0f' % (size,'',"scan",r['seconds'],r['airports_per_sec'])
+		print '%8s peak RSS %d kB' % (size,results[size]['peak_rss_kb'])
+		diff=results[size]['810']['geometry']['max_difference']
+		if diff!=None:
+			print '%8s numpy/scalar geometry difference %g degrees' % (size,max(diff,results[size]['850']['geometry']['max_difference']))
+
+
+# Throughput more than tolerance below the baseline, or peak RSS more than tolerance above it, is a regression
+def compare(results,baseline,tolerance):
+	regressions=[]
+	for size in results:
+		if size not in baseline:
+			continue
+		for version in ('810','850'):
+			for stage in STAGES:
+				if stage not in results[size][version] or stage not in baseline[size][version]:
+					continue
+				new=results[size][version][stage]['airports_per_sec']
+				old=baseline[size][version][stage]['airports_per_sec']
+				if new<old*(1-tolerance):
+					regressions.append('%s %s %s: %.0f airports/sec, baseline %.0f' % (size,version,stage,new,old))
+		new=results[size]['scan']['airports_per_sec']
+		old=baseline[size]['scan']['airports_per_sec']
+		if new<old*(1-tolerance):
+			regressions.append('%s scan: %.0f airports/sec, baseline %.0f' % (size,new,old))
+		new=results[size]['peak_rss_kb']
+		old=baseline[size]['peak_rss_kb']
+		if new>old*(1+tolerance):
+			regressions.append('%s peak RSS: %d kB, baseline %d kB' % (size,new,old))
+	for size in results:
+		for version in ('810','850'):
+			diff=results[size][version]['geometry']['max_difference']
+			if diff!=None and diff>groundnet.GEO_TOLERANCE:
+				regressions.append('%s %s geometry: numpy and scalar results differ by %g degrees' % (size,version,diff))
+	return regressions
+
+
+if __name__ == "__main__":
+	optparser=optparse.OptionParser(usage='benchmark.py [--sizes N,N,...] [--baseline FILE] [--save-baseline FILE]')
+	optparser.add_option('--sizes',default='100,1000,10000',help='numbers of default airports in each format, comma separated')
+	optparser.add_option('--ineligible',type='float',default=1.0,help='airports not fitting the default layout, per default airport')
+	optparser.add_option('--baseline',help='compare the results with this file')
+	optparser.add_option('--save-baseline',help='store the results in this file')
+	optparser.add_option('--tolerance',type='float',default=0.25,help='allowed slowdown or memory growth against the baseline')
+	optparser.add_option('--generate',metavar='DIR',help='only write a corpus to DIR, using the first size')
+	options,args=optparser.parse_args()
+	sizes=[int(size) for size in options.sizes.split(',')]
+	if options.generate:
+		generate_corpus(options.generate,sizes[0],int(sizes[0]*options.ineligible))
+		sys.exit()
+	results=run(sizes,options.ineligible)
+	report(results)
+	if options.save_baseline:
+		fw=open(options.save_baseline,'wb')
+		json.dump(results,fw,indent=1,sort_keys=True)
+		fw.close()
+	if options.baseline:
+		fr=open(options.baseline,'rb')
+		baseline=json.load(fr)
+		fr.close()
+		regressions=compare(results,baseline,options.tolerance)
+		for line in regressions:
+			print 'regression:',line
+		if len(regressions)>0:
+			sys.exit(1)
@@ -17,9 +17,42 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
-import os, sys, glob, math
-import io, multiprocessing
+import os, sys, math, time
+import io, multiprocessing, multiprocessing.pool, signal, optparse
 import re, string 
+import cPickle, hashlib, mmap, json, cProfile
+import threading, Queue, cStringIO
+import gzip, zlib, bisect, ctypes, ctypes.util
+import collections, BaseHTTPServer, SocketServer
+import array, heapq
+numpy=None   # imported by load_numpy, only the modes working on many airports need it
+def load_numpy():
+	# numpy is most of the startup time of the script, single airports do without it
+	global numpy
+	if numpy==None:
+		try:
+			import numpy as module
+			numpy=module
+		except ImportError:
+			pass
+	return numpy
+	
+try:
+	import tracemalloc
+except ImportError:
+	tracemalloc=None
+try:
+	from os import scandir
+except ImportError:
+	try:
+		from scandir import scandir
+	except ImportError:
+		scandir=None
+try:
+	libz=ctypes.CDLL(ctypes.util.find_library('z') or 'libz.so.1')
+	libz.zlibVersion.restype=ctypes.c_char_p
+except OSError:
+	libz=None
 
 __doc__="""Experimental script to generate a ground network for default airports
 Works on all airports which have the following 810 format: one runway,
@@ -29,10 +62,42 @@ of the runway. 9 parking positions are also generated near the long taxiway.
 First set path below to Airports directory inside the scenery directory.
 Ground networks will be saved in the output directory inside the current directory
 
-After the first run, a cache file named airport_list.txt or airport_list_850.txt
-is created in the working directory, containing a list of all airports in the scenery
-directory which are missing a ground network, regardless of the format of the airport.
-This makes further runs of the script execute faster.
+After the first run, a cache file named scenery_cache.dat is created in the working
+directory. For every directory of the scenery Airports tree it holds the modification
+time and the airports which are missing a ground network, regardless of the format
+of the airport. Further runs only list the directories changed since then, for example
+by a Terrasync update, so there is no need to delete the cache by hand.
+The Airports/X/Y subtrees are listed by a pool of threads (scan_threads in the
+script, 8 by default), which helps on network file systems and cold disk caches.
+
+Generated airports are recorded in build_manifest.dat in the working directory, together
+with a hash of their apt.dat record and the generator parameters. Further runs only
+generate airports whose record or parameters changed. Delete build_manifest.dat to
+generate everything again. Finished airports are also appended to a journal, so a
+killed run resumes where it stopped. Failed airports stay quarantined until their record
+or the parameters change. Batches running out of time (AIRPORT_TIMEOUT per airport) or
+lost with their worker are retried airport by airport.
+Files are written by a pool of threads through a temporary file and a rename, and a file
+whose content did not change is left alone, keeping its modification time.
+
+An index file named apt.dat.idx or apt850.dat.idx is also created next to the data
+file, holding the byte offset of every airport record. It is rebuilt automatically
+when the data file changes, so later runs do not need to scan the whole file.
+Generating a single airport only memory-maps the data file and reads the record
+of that airport, the scenery directory is not scanned in this mode.
+
+apt.dat.gz and apt850.dat.gz are read directly when the uncompressed file is not in
+the working directory. A file named apt.dat.gz.seek holds a seek point every megabyte
+of uncompressed data, so single records are inflated only from the nearest point.
+
+If numpy is installed, the taxiway end points and parking positions of each batch
+of airports are computed in one vectorized call. Without numpy the same formulas
+are evaluated point by point. numpy is only imported by all, batch and sweep.
+The indexes, the manifest and the scenery scan are loaded on first use.
+
+Every generated network is checked before it is written: segment lengths, overlapping
+parkings, nodes far from the runways and hold points on a runway. Networks failing the
+checks go to the quarantine directory, listed with the reasons in quarantine/report.txt.
 
 Version 0.2: The script now can parse v850 airports which fit the same default
 format. To use the 850 parser you need a apt850.dat file in the working directory.
@@ -43,627 +108,2947 @@ groundnet.py all -> generates all airports which fit the criteria
 groundnet.py airport <ICAO> -> generates only one airport for the ICAO code provided
 
 groundnet.py all 850 -> generates all airports from apt850.dat which fit the criteria
+groundnet.py batch [850|both] [ICAO ...] [--list FILE|-] [--match REGEX] -> generates the given
+airports again in one run, the codes listed in FILE (- for stdin) and those matching REGEX
+at their start, like ED for all codes beginning with ED
+groundnet.py sweep [850|both] [ICAO ...] --spacing 60,70 --distance 40,50 -> generates the
+selected airports, all of them without a selection, once for every parking spacing and
+distance, into sweep/spacing<M>_distance<M>. Records are read and the taxiway ends
+computed only once.
+groundnet.py merge [850|both] N -> copies the output of the N shards written by all --shard
+into output and output850 and merges their manifests, after checking that every airport
+all would generate was built by exactly one shard, its own, from its current record
+groundnet.py serve [850|both] -> keeps the index loaded and answers GET /<ICAO>, /810/<ICAO>
+or /850/<ICAO> with the groundnet xml, on http://127.0.0.1:8642/ or on --socket PATH
+groundnet.py all both -> generates the airports of apt.dat and apt850.dat in one run,
+sharing the scenery scan, the manifest and the worker pool
 groundnet.py airport <ICAO> 850 -> generates only one airport for the ICAO code provided
+
+Options for all:
+-j N, --workers N -> number of worker processes, defaults to the number of CPUs
+--chunk N -> number of airports handed to a worker at once
+--stream -> generates while reading the data files, with at most two batches per worker
+in flight, so memory stays flat and the first files appear right away
+--bbox W,S,E,N -> only generates the airports inside the box, in degrees
+--tile INDEX -> only generates the airports inside the scenery tile with this number
+--near LAT,LON,KM -> only generates the airports within KM kilometers of LAT,LON
+--routes -> also writes <ICAO>.routes.json with the shortest taxi route from every
+parking to every hold point (not with --stream, also accepted by airport)
+--profile DIR -> writes a cProfile file for every worker process to DIR
+--shard K/N -> only generates the airports of shard K out of N, picked by a hash of the
+ICAO code, into shards/K-of-N with its own manifest
+
+Options for all and airport:
+--stats FILE -> writes a JSON summary of the run to FILE: seconds spent in every stage,
+airport counts, per airport latency percentiles, failures and warnings
 """
 
-class Groundnet:
+INDEX_VERSION=4
+SEEK_VERSION=2
+SEEK_SPAN=1<<20       # uncompressed bytes between the seek points of a gzip data file
+SCENERY_CACHE_VERSION=1
+MANIFEST_VERSION=2
+GENERATOR_VERSION=2   # bump when the generated files change for the same input
+EARTH_RADIUS=6371000.0   # meters
+SERVE_PORT=8642       # default localhost port of the serve mode
+WRITER_THREADS=4      # threads writing the output files of every process
+STREAM_CHUNK=8        # airports per batch in stream mode, small so that files appear early
+AIRPORT_TIMEOUT=10.0  # seconds a worker may spend on one airport before giving it up
+RETRIES=1             # rounds retrying one by one the airports of batches that timed out or got lost
+STRAGGLER_GRACE=30.0  # seconds on top of the timeouts before the parent gives up waiting for a batch
+FORMAT_810=1   # record fits the default 810 layout
+FORMAT_850=2   # record fits the default 850 layout
+
+HEADER_RE=re.compile("^1\s+[0-9]+\s+[0-9]+\s+[0-9]+\s+([0-9A-Z]{3,5})\s+")
+XML_RE=re.compile(".xml")
+RECORD_END_RE=re.compile("\n(?:(\r?\n)|1[ \t])")
+
+# Row codes of an airport record, the first token of its lines
+RUNWAY_810_ROW='10'
+RUNWAY_850_ROW='100'
+PAVEMENT_850_ROW='110'
+NODE_850_ROWS=('111','112','113','114','115','116')
+LAYOUT_850_ROWS=('110','111','112','120')   # rows counted to recognize the default 850 layout
+FREQUENCY_ROWS=tuple([str(code) for code in range(50,60)])
+
+Z_OK=0
+Z_STREAM_END=1
+Z_BUF_ERROR=-5
+Z_BLOCK=5
+
+
+class ZStream(ctypes.Structure):
+	_fields_=[('next_in',ctypes.c_void_p),('avail_in',ctypes.c_uint),('total_in',ctypes.c_ulong),
+		('next_out',ctypes.c_void_p),('avail_out',ctypes.c_uint),('total_out',ctypes.c_ulong),
+		('msg',ctypes.c_char_p),('state',ctypes.c_void_p),
+		('zalloc',ctypes.c_void_p),('zfree',ctypes.c_void_p),('opaque',ctypes.c_void_p),
+		('data_type',ctypes.c_int),('adler',ctypes.c_ulong),('reserved',ctypes.c_ulong)]
+
+
+# Flag of the records fitting the default layout of version
+def format_flag(version):
+	if version==850:
+		return FORMAT_850
+	return FORMAT_810
+	
+	
+# Byte offset index of the airport records in an apt.dat file. It is saved next to
+# the data file and rebuilt when the size, mtime and sha1 of the data file change.
+# For apt.dat.gz the offsets are in the uncompressed data and the seek points of the
+# file are saved in apt.dat.gz.seek.
+class AptIndex:
+	def __init__(self,path,version=810):
+		self.path=path
+		self.index_path=path+'.idx'
+		self.version=version
+		self.compressed=path.endswith('.gz')
+		self.points=None   # seek points found while scanning a gzip file
+		self.source=None
+		self.records=[]    # [icao,offset,length,flags,freq rows,record sha1,(lat,lon) or None] in file order
+		self.airports={}   # icao -> record used for that airport
+		self.eligible=[]   # icaos fitting the default layout of self.version
+		self.data=None
+		self.spatial=None
+		
+	
+	def load(self,build=True):
+		if self.check():
+			return self
+		if not build:
+			return None
+		print "Indexing",os.path.basename(self.path)
+		self.build()
+		self.save()
+		return self
+		
+	
+	def check(self):
+		st=os.stat(self.path)
+		try:
+			fr=open(self.index_path,'rb')
+			data=cPickle.load(fr)
+			fr.close()
+		except (IOError,EOFError,cPickle.UnpicklingError):
+			data=None
+		if data!=None and data.get('version')==INDEX_VERSION and data.get('format')==self.version:
+			source=data['source']
+			if source['size']==st.st_size and source['mtime']==st.st_mtime:
+				self.set_records(source,data['records'])
+				return True
+			if source['size']==st.st_size and source['sha1']==self.hash_file():
+				# touched or copied, but the content is the same
+				source['mtime']=st.st_mtime
+				self.set_records(source,data['records'])
+				if self.compressed:
+					# and so are the seek points, saved again with the new mtime
+					self.points=load_seek_points(self.path,True)
+				self.save()
+				return True
+		return False
+		
+	
+	def hash_file(self):
+		# sha1 of the uncompressed data, as computed by scan
+		sha=hashlib.sha1()
+		if self.compressed:
+			fr=gzip.open(self.path,'rb')
+		else:
+			fr=open(self.path,'rb')
+		while True:
+			buf=fr.read(1<<20)
+			if not buf:
+				break
+			sha.update(buf)
+		fr.close()
+		return sha.hexdigest()
+		
+	
+	def build(self):
+		records=list(self.scan())
+		self.set_records(self.source,records)
+		
+	
+	def scan(self):
+		# yields the records while reading the data file, self.source is set at the end
+		if self.version==850:
+			freq_end=40
+		else:
+			freq_end=25
+		st=os.stat(self.path)
+		sha=hashlib.sha1()
+		rec=None
+		offset=0
+		raw=None
+		if self.compressed and libz!=None:
+			raw=InflateStream(self.path,span=SEEK_SPAN)
+			fr=io.BufferedReader(raw,1<<16)
+		elif self.compressed:
+			fr=gzip.open(self.path,'rb')
+		else:
+			fr=open(self.path,'rb')
+		for line in fr:
+			sha.update(line)
+			if line[:2]=='1 ' or line[:2]=='1\t':
+				if rec!=None:
+					yield rec.record(offset)
+				rec=RecordScanner(line,offset,freq_end)
+			elif rec!=None:
+				rec.sha.update(line)
+				if line=='\n' or line=='\r\n':
+					yield rec.record(offset+len(line))
+					rec=None
+				else:
+					rec.feed(line)
+			offset+=len(line)
+		if rec!=None:
+			yield rec.record(offset)
+		fr.close()
+		if raw!=None:
+			self.points=raw.points
+		self.source={'size':st.st_size,'mtime':st.st_mtime,'sha1':sha.hexdigest()}
+		
+	
+	def save(self):
+		data={'version':INDEX_VERSION,'format':self.version,'source':self.source,'records':self.records}
+		tmp_path='%s.%d.tmp' % (self.index_path,os.getpid())
+		fw=open(tmp_path,'wb')
+		cPickle.dump(data,fw,cPickle.HIGHEST_PROTOCOL)
+		fw.close()
+		os.rename(tmp_path,self.index_path)
+		if self.points!=None:
+			save_seek_points(self.path,self.points)
+		
+	
+	def set_records(self,source,records):
+		flag=format_flag(self.version)
+		self.source=source
+		self.records=records
+		self.airports={}
+		self.eligible=[]
+		for rec in records:
+			icao=rec[0]
+			current=self.airports.get(icao)
+			if current==None:
+				self.airports[icao]=rec
+				if rec[3] & flag:
+					self.eligible.append(icao)
+			elif rec[3] & flag and not current[3] & flag:
+				# a later record with the same code fits the layout, prefer it
+				self.airports[icao]=rec
+				self.eligible.append(icao)
+		
+	
+	def grid(self):
+		if self.spatial==None:
+			self.spatial=SpatialGrid(self.airports.values())
+		return self.spatial
+		
+	
+	def open(self):
+		if self.data==None:
+			self.data=open_data(self.path,self.points)
+		return self.data
+		
+	
+	def read_record(self,icao):
+		rec=self.airports[icao]
+		return self.open()[rec[1]:rec[1]+rec[2]].splitlines(True)
+		
+	
+	def find_record(self,icao):
+		# used when there is no valid index, searches the mapped file for the header
+		if self.compressed:
+			for rec in self.scan():
+				if rec[0]==icao:
+					return self.open()[rec[1]:rec[1]+rec[2]].splitlines(True)
+			return None
+		data=self.open()
+		match=re.compile("^1[ \t]+[0-9]+[ \t]+[0-9]+[ \t]+[0-9]+[ \t]+"+re.escape(icao)+"\s",re.M).search(data)
+		if match==None:
+			return None
+		start=match.start()
+		end=RECORD_END_RE.search(data,match.end())
+		if end==None:
+			end=len(data)
+		elif end.group(1)!=None:
+			end=end.end()
+		else:
+			end=end.start()+1
+		return data[start:end].splitlines(True)
+		
+	
+	def get_record(self,icao):
+		if self.source==None:
+			return self.find_record(icao)
+		if icao not in self.airports:
+			return None
+		return self.read_record(icao)
+		
+		
+# Splits a line of an airport record once and hands its tokens to the handler of its
+# row code in rows. Handlers take (reader,num,tokens,line), num being the line number
+# in the record, the header being 0. Shared by the index scan and the parsers.
+def dispatch_row(rows,reader,num,line):
+	tokens=line.split()
+	if tokens:
+		handler=rows.get(tokens[0])
+		if handler!=None:
+			handler(reader,num,tokens,line)
+			
+			
+def is_taxiway_810(tokens):
+	return len(tokens)>5 and tokens[3]=='xxx'
+	
+	
+def is_frequency(tokens):
+	return len(tokens)>1 and len(tokens[1])==5 and tokens[1].isdigit()
+	
+	
+def is_decimal(token):
+	return token.strip('0123456789.')==''
+	
+	
+# Classifies one airport record while the index streams through the file
+class RecordScanner:
+	def __init__(self,header,offset,freq_end):
+		tokens=header.split()
+		if len(tokens)>4:
+			self.icao=tokens[4]
+		else:
+			self.icao=''
+		self.valid=HEADER_RE.search(header)!=None
+		self.sha=hashlib.sha1(header)
+		self.offset=offset
+		self.freq_end=freq_end
+		self.num=0
+		self.seg_len=[]
+		self.counts=dict.fromkeys(LAYOUT_850_ROWS,0)
+		self.freqs=[]
+		self.coord=None
+		
+	
+	def feed(self,line):
+		self.num+=1
+		dispatch_row(self.ROWS,self,self.num,line)
+		
+	
+	# row handlers, one call per line classifies both formats and collects the frequencies
+	def runway_810(self,num,tokens,line):
+		if num<10 and is_taxiway_810(tokens):
+			self.seg_len.append(tokens[5])
+		self.position(tokens)
+		
+	
+	def runway_850(self,num,tokens,line):
+		self.position(tokens)
+		
+	
+	def layout_850(self,num,tokens,line):
+		if num<40:
+			self.counts[tokens[0]]+=1
+			
+	
+	def node_850(self,num,tokens,line):
+		if num<40 and tokens[0] in self.counts:
+			self.counts[tokens[0]]+=1
+		self.position(tokens)
+		
+	
+	def frequency(self,num,tokens,line):
+		if num>=4 and num<self.freq_end and is_frequency(tokens):
+			self.freqs.append(line.rstrip('\r\n'))
+			
+	
+	def position(self,tokens):
+		if self.coord==None:
+			self.coord=reference_point(tokens)
+			
+	
+	ROWS=dict.fromkeys(FREQUENCY_ROWS,frequency)
+	ROWS.update(dict.fromkeys(LAYOUT_850_ROWS,layout_850))
+	ROWS.update(dict.fromkeys(NODE_850_ROWS,node_850))
+	ROWS.update({RUNWAY_810_ROW:runway_810,RUNWAY_850_ROW:runway_850})
+	
+	
+	def record(self,end):
+		flags=0
+		if self.valid:
+			seg_len=self.seg_len
+			if len(seg_len)==4:
+				if seg_len[0]==seg_len[1] and seg_len[0]==seg_len[2] and float(seg_len[0])<float(seg_len[3]) and float(seg_len[3])>=2000:
+					flags|=FORMAT_810
+			counts=self.counts
+			if counts['111']==14 and counts['110']==1 and counts['112']==4 and counts['120']==3:
+				flags|=FORMAT_850
+		return [self.icao,self.offset,end-self.offset,flags,self.freqs,self.sha.hexdigest(),self.coord]
+		
+		
+# Position of an airport from its first runway or pavement node row
+def reference_point(tokens):
+	try:
+		if tokens[0]=='100':
+			return ((float(tokens[9])+float(tokens[18]))/2,(float(tokens[10])+float(tokens[19]))/2)
+		return (float(tokens[1]),float(tokens[2]))
+	except (ValueError,IndexError):
+		return None
+		
+		
+# Uncompressed data of a gzip file as a raw stream, inflated through libz. Started at the
+# beginning of the file it records a seek point every span bytes of output: the position
+# of a deflate block boundary in both streams and the 32K window before it, as zran.c in
+# the zlib examples does. Started at a seek point it inflates from there. Every member
+# of a gzip file made of several is read, as the gzip module does.
+class InflateStream(io.RawIOBase):
+	def __init__(self,path,point=None,span=None):
+		io.RawIOBase.__init__(self)
+		self.fr=open(path,'rb')
+		self.strm=ZStream()
+		self.span=span
+		self.points=[]    # (output offset,input offset,bits,compressed window)
+		self.window=''
+		self.last=0
+		self.end=False
+		self.inbuf=None
+		self.outbuf=ctypes.create_string_buffer(1<<16)
+		if point==None:
+			self.init(47)   # gzip or zlib header
+			self.raw=False
+			self.base=0     # file offset of the input of the current member
+			self.pos=0
+		else:
+			out,offset,bits,window=point
+			self.init(-15)  # raw deflate
+			self.raw=True
+			self.base=offset
+			self.fr.seek(offset-(bits and 1))
+			if bits:
+				self.check(libz.inflatePrime(ctypes.byref(self.strm),bits,ord(self.fr.read(1))>>(8-bits)))
+			window=zlib.decompress(window)
+			if len(window)>0:
+				self.check(libz.inflateSetDictionary(ctypes.byref(self.strm),window,len(window)))
+			self.pos=out
+			
+	
+	def init(self,wbits):
+		self.check(libz.inflateInit2_(ctypes.byref(self.strm),wbits,libz.zlibVersion(),ctypes.sizeof(ZStream)))
+		
+	
+	def check(self,ret):
+		if ret!=Z_OK:
+			raise IOError("zlib error %d in %s" % (ret,self.fr.name))
+		
+	
+	def readable(self):
+		return True
+		
+	
+	def readinto(self,b):
+		strm=self.strm
+		while not self.end:
+			if strm.avail_in==0:
+				data=self.fr.read(1<<16)
+				if not data:
+					raise IOError("unexpected end of "+self.fr.name)
+				self.inbuf=ctypes.create_string_buffer(data,len(data))
+				strm.next_in=ctypes.addressof(self.inbuf)
+				strm.avail_in=len(data)
+			size=min(len(b),len(self.outbuf))
+			strm.next_out=ctypes.addressof(self.outbuf)
+			strm.avail_out=size
+			ret=libz.inflate(ctypes.byref(strm),Z_BLOCK)
+			if ret==Z_STREAM_END:
+				self.next_member()
+			elif ret!=Z_OK and ret!=Z_BUF_ERROR:
+				raise IOError("zlib error %d in %s" % (ret,self.fr.name))
+			n=size-strm.avail_out
+			data=self.outbuf.raw[:n]
+			self.pos+=n
+			if self.span!=None:
+				self.window=(self.window+data)[-32768:]
+				if strm.data_type & 128 and not strm.data_type & 64 and (self.pos==0 or self.pos-self.last>self.span):
+					self.points.append((self.pos,self.base+strm.total_in,strm.data_type & 7,zlib.compress(self.window)))
+					self.last=self.pos
+			if n>0:
+				b[:n]=data
+				return n
+		return 0
+		
+	
+	def next_member(self):
+		# starts inflating the member following the one which just ended, if any. Zero
+		# padding after the last member is ignored, as the gzip module does.
+		strm=self.strm
+		rest=''
+		if strm.avail_in>0:
+			rest=ctypes.string_at(strm.next_in,strm.avail_in)
+		if self.raw:
+			# a raw stream started at a seek point stops before the crc and size trailer
+			while len(rest)<8:
+				data=self.fr.read(1<<16)
+				if not data:
+					raise IOError("unexpected end of "+self.fr.name)
+				rest+=data
+			rest=rest[8:]
+		rest=rest.lstrip('\0')
+		while rest=='':
+			data=self.fr.read(1<<16)
+			if not data:
+				self.end=True
+				return
+			rest=data.lstrip('\0')
+		self.base=self.fr.tell()-len(rest)
+		libz.inflateEnd(ctypes.byref(strm))
+		self.inbuf=ctypes.create_string_buffer(rest,len(rest))
+		strm.next_in=ctypes.addressof(self.inbuf)
+		strm.avail_in=len(rest)
+		self.init(47)
+		self.raw=False
+		
+	
+	def close(self):
+		if not self.closed:
+			libz.inflateEnd(ctypes.byref(self.strm))
+			self.fr.close()
+		io.RawIOBase.close(self)
+		
+		
+# Random access to the uncompressed data of a gzip file, sliced like the mmap of a
+# plain data file. Reads inflate from the nearest seek point, or go on from the end of
+# the previous read when that is closer. Without libz or seek points the gzip module
+# is used, which inflates from the start of the file for every backward read.
+class GzipData:
+	def __init__(self,path,points):
+		self.path=path
+		self.points=points
+		self.outs=[p[0] for p in points or []]
+		self.stream=None
+		
+	
+	def __getslice__(self,start,end):
+		return self.read(start,end-start)
+		
+	
+	def read(self,offset,length):
+		if libz==None or not self.points:
+			if self.stream==None:
+				self.stream=gzip.open(self.path,'rb')
+			self.stream.seek(offset)
+			return self.stream.read(length)
+		point=self.points[bisect.bisect_right(self.outs,offset)-1]
+		if self.stream==None or self.stream.pos<point[0] or self.stream.pos>offset:
+			if self.stream!=None:
+				self.stream.close()
+			self.stream=InflateStream(self.path,point)
+		while self.stream.pos<offset:
+			self.stream.read(min(offset-self.stream.pos,1<<16))
+		data=[]
+		while length>0:
+			buf=self.stream.read(length)
+			if not buf:
+				break
+			data.append(buf)
+			length-=len(buf)
+		return ''.join(data)
+		
+		
+def open_data(path,points=None):
+	if path.endswith('.gz'):
+		if points==None:
+			points=load_seek_points(path)
+		return GzipData(path,points)
+	fr=open(path,'rb')
+	data=mmap.mmap(fr.fileno(),0,access=mmap.ACCESS_READ)
+	fr.close()
+	return data
+	
+	
+# With any_mtime the points are returned even when the file was touched since
+def load_seek_points(path,any_mtime=False):
+	try:
+		fr=open(path+'.seek','rb')
+		data=cPickle.load(fr)
+		fr.close()
+	except (IOError,EOFError,cPickle.UnpicklingError):
+		return None
+	st=os.stat(path)
+	if data.get('version')!=SEEK_VERSION or data.get('size')!=st.st_size:
+		return None
+	if data.get('mtime')!=st.st_mtime and not any_mtime:
+		return None
+	return data['points']
+	
+	
+def save_seek_points(path,points):
+	st=os.stat(path)
+	data={'version':SEEK_VERSION,'size':st.st_size,'mtime':st.st_mtime,'points':points}
+	tmp_path='%s.seek.%d.tmp' % (path,os.getpid())
+	fw=open(tmp_path,'wb')
+	cPickle.dump(data,fw,cPickle.HIGHEST_PROTOCOL)
+	fw.close()
+	os.rename(tmp_path,path+'.seek')
+	
+	
+# Part of the world selected for all: boxes of (south,west,north,east) degrees,
+# optionally limited to radius meters around center
+class Region:
+	def __init__(self,boxes,center=None,radius=None):
+		self.boxes=boxes
+		self.center=center
+		self.radius=radius
+		
+	
+	def contains(self,lat,lon):
+		for south,west,north,east in self.boxes:
+			if south<=lat<=north and west<=lon<=east:
+				break
+		else:
+			return False
+		if self.center!=None:
+			return great_circle(self.center[0],self.center[1],lat,lon)<=self.radius
+		return True
+		
+		
+# --bbox WEST,SOUTH,EAST,NORTH, a box crossing the antimeridian has WEST>EAST
+def bbox_region(text):
+	west,south,east,north=[float(t) for t in text.split(',')]
+	if west>east:
+		return Region([(south,west,north,180.0),(south,-180.0,north,east)])
+	return Region([(south,west,north,east)])
+	
+	
+# --tile INDEX, the FlightGear scenery tile (SGBucket) number
+def tile_region(text):
+	index=int(text)
+	lon=(index>>14)-180
+	lat=((index>>6) & 0xff)-90
+	y=(index>>3) & 7
+	x=index & 7
+	south=lat+y/8.0
+	span=bucket_span(south+1/16.0)
+	west=lon+x*span
+	return Region([(south,west,south+1/8.0,west+span)])
+	
+	
+# Width in degrees of the scenery tiles at a latitude, as sg_bucket_span in SimGear
+def bucket_span(lat):
+	for limit,span in ((89.0,12.0),(86.0,4.0),(83.0,2.0),(76.0,1.0),(62.0,0.5),(22.0,0.25),(-22.0,0.125),
+			(-62.0,0.25),(-76.0,0.5),(-83.0,1.0),(-86.0,2.0),(-89.0,4.0)):
+		if lat>=limit:
+			return span
+	return 12.0
+	
+	
+# --near LAT,LON,KM
+def near_region(text):
+	lat,lon,km=[float(t) for t in text.split(',')]
+	radius=km*1000.0
+	dlat=math.degrees(radius/EARTH_RADIUS)
+	south=max(-90.0,lat-dlat)
+	north=min(90.0,lat+dlat)
+	if north>=90.0 or south<=-90.0 or math.cos(math.radians(max(abs(south),abs(north))))*180.0<=dlat:
+		boxes=[(south,-180.0,north,180.0)]
+	else:
+		dlon=dlat/math.cos(math.radians(max(abs(south),abs(north))))
+		west=lon-dlon
+		east=lon+dlon
+		if west<-180.0:
+			boxes=[(south,west+360.0,north,180.0),(south,-180.0,north,east)]
+		elif east>180.0:
+			boxes=[(south,west,north,180.0),(south,-180.0,north,east-360.0)]
+		else:
+			boxes=[(south,west,north,east)]
+	return Region(boxes,(lat,lon),radius)
+	
+	
+def great_circle(lat1,lon1,lat2,lon2):
+	lat1=math.radians(lat1)
+	lat2=math.radians(lat2)
+	h=math.sin((lat2-lat1)/2)**2+math.cos(lat1)*math.cos(lat2)*math.sin(math.radians(lon2-lon1)/2)**2
+	return 2*EARTH_RADIUS*math.asin(min(1.0,math.sqrt(h)))
+	
+	
+# Airports of an index in cells of one degree, by the reference point of their record
+class SpatialGrid:
+	def __init__(self,records):
+		self.cells={}   # (floor lat,floor lon) -> records
+		for rec in records:
+			if rec[6]!=None:
+				lat,lon=rec[6]
+				self.cells.setdefault((int(math.floor(lat)),int(math.floor(lon))),[]).append(rec)
+				
+	
+	def query(self,region):
+		found=[]
+		for south,west,north,east in region.boxes:
+			for lat in range(int(math.floor(south)),int(math.floor(north))+1):
+				for lon in range(int(math.floor(west)),int(math.floor(east))+1):
+					for rec in self.cells.get((lat,lon),()):
+						if region.contains(rec[6][0],rec[6][1]):
+							found.append(rec[0])
+		return found
+		
+		
+# Remembers every directory of the scenery Airports tree with its mtime and the
+# airports missing a ground network in it. Only directories whose mtime changed
+# since the last run are listed again.
+class SceneryCache:
+	def __init__(self,root,path):
+		self.root=root
+		self.path=path
+		self.dirs={}       # path relative to root -> (mtime,subdirectories,missing icaos)
+		self.changed=False
+		
+	
+	def load(self):
+		try:
+			fr=open(self.path,'rb')
+			data=cPickle.load(fr)
+			fr.close()
+		except (IOError,EOFError,cPickle.UnpicklingError):
+			return
+		if data.get('version')==SCENERY_CACHE_VERSION and data.get('root')==self.root:
+			self.dirs=data['dirs']
+			
+	
+	def save(self):
+		data={'version':SCENERY_CACHE_VERSION,'root':self.root,'dirs':self.dirs}
+		tmp_path='%s.%d.tmp' % (self.path,os.getpid())
+		fw=open(tmp_path,'wb')
+		cPickle.dump(data,fw,cPickle.HIGHEST_PROTOCOL)
+		fw.close()
+		os.rename(tmp_path,self.path)
+		
+	
+	def scan(self,check,threads=1):
+		# the root and the Airports/X directories are listed here, the
+		# Airports/X/Y subtrees are spread over a pool of threads
+		visited={}
+		subtrees=[]
+		for rel in self.scan_dir('',check,visited):
+			subtrees.extend(self.scan_dir(rel,check,visited))
+		if threads>1 and len(subtrees)>1:
+			pool=multiprocessing.pool.ThreadPool(min(threads,len(subtrees)))
+			try:
+				results=pool.map(lambda rel: self.scan_tree(rel,check),subtrees)
+			finally:
+				pool.close()
+				pool.join()
+		else:
+			results=[self.scan_tree(rel,check) for rel in subtrees]
+		for result in results:
+			visited.update(result)
+		if len(visited)!=len(self.dirs):
+			self.changed=True
+		self.dirs=visited
+		missing=set()
+		for entry in self.dirs.itervalues():
+			missing.update(entry[2])
+		return missing
+		
+	
+	def scan_tree(self,rel,check):
+		visited={}
+		pending=[rel]
+		while len(pending)>0:
+			pending.extend(self.scan_dir(pending.pop(),check,visited))
+		return visited
+		
+	
+	def scan_dir(self,rel,check,visited):
+		# adds the entry of one directory to visited, returns its subdirectories
+		path=os.path.join(self.root,rel)
+		try:
+			mtime=os.stat(path).st_mtime
+		except OSError:
+			return []
+		entry=self.dirs.get(rel)
+		if entry==None or entry[0]!=mtime:
+			subdirs,files=list_dir(path)
+			entry=(mtime,subdirs,check(path,files))
+			self.changed=True
+		visited[rel]=entry
+		return [os.path.join(rel,d) for d in entry[1]]
+		
+			
+# One read of a directory, split into subdirectories and files.
+# Without scandir, names looking like scenery files are taken as files without a stat.
+def list_dir(path):
+	subdirs=[]
+	files=[]
+	if scandir!=None:
+		for entry in scandir(path):
+			if entry.is_dir():
+				if entry.name!='.svn':
+					subdirs.append(entry.name)
+			else:
+				files.append(entry.name)
+		return subdirs,files
+	for name in os.listdir(path):
+		if XML_RE.search(name)==None and os.path.isdir(os.path.join(path,name)):
+			if name!='.svn':
+				subdirs.append(name)
+		else:
+			files.append(name)
+	return subdirs,files
+	
+	
+# Records for every generated airport the sha1 of the apt.dat record and the
+# parameters it was generated with, so that only stale airports are generated again
+class BuildManifest:
+	def __init__(self,path):
+		self.path=path
+		self.airports={810:{},850:{}}   # version -> icao -> (record sha1,parameters)
+		self.failed={810:{},850:{}}     # version -> icao -> (record sha1,parameters,error) of quarantined airports
+		self.journal=None               # append-only log of the changes since the last save
+		
+	
+	def load(self):
+		try:
+			fr=open(self.path,'rb')
+			data=cPickle.load(fr)
+			fr.close()
+		except (IOError,EOFError,cPickle.UnpicklingError):
+			data={}
+		if data.get('version')==MANIFEST_VERSION:
+			self.airports=data['airports']
+			self.failed=data['failed']
+		elif data.get('version')==1:
+			self.airports=data['airports']
+		self.replay()
+		return self
+		
+	
+	def replay(self):
+		# changes of a run which stopped before saving, one JSON list per line
+		try:
+			fr=open(self.path+'.journal','rb')
+		except IOError:
+			return
+		for line in fr:
+			try:
+				entry=json.loads(line)
+			except ValueError:
+				# the last line of a killed run may be cut
+				continue
+			op,version,icao=entry[:3]
+			icao=str(icao)
+			if op=='+':
+				self.airports[version][icao]=(str(entry[3]),tuple(entry[4]))
+				self.failed[version].pop(icao,None)
+			elif op=='!':
+				self.airports[version].pop(icao,None)
+				self.failed[version][icao]=(str(entry[3]),tuple(entry[4]),entry[5])
+		fr.close()
+		
+	
+	def log(self,entry):
+		if self.journal==None:
+			self.journal=open(self.path+'.journal','ab')
+		self.journal.write(json.dumps(entry)+'\n')
+		self.journal.flush()
+		
+	
+	def save(self):
+		data={'version':MANIFEST_VERSION,'airports':self.airports,'failed':self.failed}
+		tmp_path='%s.%d.tmp' % (self.path,os.getpid())
+		fw=open(tmp_path,'wb')
+		cPickle.dump(data,fw,cPickle.HIGHEST_PROTOCOL)
+		fw.close()
+		os.rename(tmp_path,self.path)
+		# everything in the journal is in the saved file now
+		if self.journal!=None:
+			self.journal.close()
+			self.journal=None
+		if os.path.exists(self.path+'.journal'):
+			os.remove(self.path+'.journal')
+		
+	
+	def is_current(self,version,icao,record_hash,params):
+		return self.airports[version].get(icao)==(record_hash,params)
+		
+	
+	def is_quarantined(self,version,icao,record_hash,params):
+		# failed before with the same record and parameters
+		return self.failed[version].get(icao,(None,None))[:2]==(record_hash,params)
+		
+	
+	def update(self,version,icao,record_hash,params):
+		self.airports[version][icao]=(record_hash,params)
+		self.failed[version].pop(icao,None)
+		self.log(['+',version,icao,record_hash,params])
+		
+	
+	def quarantine(self,version,icao,record_hash,params,error):
+		self.airports[version].pop(icao,None)
+		self.failed[version][icao]=(record_hash,params,error)
+		self.log(['!',version,icao,record_hash,params,error])
+		
+		
+# Timing counters of a run. Workers keep their own and send them back with the
+# results, the parent merges them and saves a JSON summary
+class Stats:
+	def __init__(self):
+		self.times={}        # stage -> seconds
+		self.counts={}
+		self.latencies=[]    # seconds per generated airport
+		self.failures=[]     # (icao,error)
+		self.quarantined=[]  # (icao,version,problems,output root or None) of the networks failing validation
+		self.warnings=[]     # (icao,message)
+		self.peak_memory=None   # largest worker allocation traced by tracemalloc
+		self.started=time.time()
+		
+	
+	def add_time(self,stage,seconds):
+		self.times[stage]=self.times.get(stage,0.0)+seconds
+		
+	
+	def count(self,name,n=1):
+		self.counts[name]=self.counts.get(name,0)+n
+		
+	
+	def dump(self):
+		return (self.times,self.counts,self.latencies,self.warnings,self.quarantined,self.peak_memory)
+		
+	
+	def merge(self,data):
+		times,counts,latencies,warnings,quarantined,peak_memory=data
+		for stage in times:
+			self.add_time(stage,times[stage])
+		for name in counts:
+			self.count(name,counts[name])
+		self.latencies.extend(latencies)
+		self.warnings.extend(warnings)
+		self.quarantined.extend(quarantined)
+		if peak_memory!=None:
+			self.peak_memory=max(self.peak_memory,peak_memory)
+			
+	
+	def summary(self):
+		latencies=sorted(self.latencies)
+		latency={'count':len(latencies)}
+		if len(latencies)>0:
+			latency['mean']=sum(latencies)/len(latencies)
+			for p in (50,90,99):
+				latency['p%d' % p]=percentile(latencies,p)
+			latency['max']=latencies[-1]
+		return {'stages':self.times,'counts':self.counts,'latency':latency,
+			'failures':[{'airport':a,'error':e} for a,e in self.failures],
+			'warnings':[{'airport':a,'message':m} for a,m in self.warnings],
+			'quarantined':[{'airport':a,'format':v,'problems':p,'directory':root} for a,v,p,root in self.quarantined],
+			'worker_peak_memory':self.peak_memory}
+		
+	
+	def save(self,path):
+		fw=open(path,'wb')
+		json.dump(self.summary(),fw,indent=1,sort_keys=True)
+		fw.write('\n')
+		fw.close()
+		
+		
+# Nearest rank percentile of a sorted list
+def percentile(values,p):
+	k=int(math.ceil(p/100.0*len(values)))-1
+	return values[max(0,k)]
+	
+	
+class Groundnet(object):
 	def __init__(self,version=810):
 		self.scenery_airports="/home/adrian/games/fgfs/terrasync/Airports/" # path to Airports directory inside scenery dir
 		self.save_tree=True   # true if the generated files should be saved in a tree structure similar to the scenery one
 		self.park_spacing=60  # space in meters between centers of parking positions
 		self.park_distance=50 # space in meters between taxiway and parking pos. 
-		self.default_airports=[]
-		self.apt_index=[]
-		self.missing_network=[]
-		self.done_files=[]
-		self.version=version
-		if self.version==850:
-			self.load_apt_850()
+		self.workers=None     # number of worker processes, None uses one per CPU
+		self.scan_threads=8   # threads listing the scenery directories
+		self.chunk_size=None  # airports handed to a worker at once, None picks one from the number of airports
+		self.profile_dir=None # directory for per worker cProfile output, None disables profiling
+		self.region=None      # Region limiting all to some airports, None for the whole world
+		self.shard=None       # (k,n) to generate only the airports of shard k out of n
+		self.output_root=None # directory of the output trees and the manifest, None for the working directory
+		self.routes=False     # true to write the parking to hold point routes next to the ground networks
+		self.stats=Stats()
+		# a tuple of versions generates both formats in one run
+		if isinstance(version,tuple):
+			self.versions=version
 		else:
-			self.load_apt()
-		self.check_already_done()
-		self.get_airport_list()
+			self.versions=(version,)
+		self.version=self.versions[0]
+		# Everything below is loaded on first use, so that every mode only pays for the
+		# steps it needs and the settings above can be changed after construction
+		self.indexes={}               # version -> AptIndex, see index()
+		self._manifest=None
+		self._missing_network=None
+		self._done_files=None
+		self._apts=None
 		
-		self.apts = (set(self.default_airports) & set(self.missing_network)) - set(self.done_files)
+	
+	def index(self,version):
+		if version not in self.indexes:
+			self.load_index(version)
+		return self.indexes[version]
 		
+	
+	@property
+	def manifest(self):
+		# BuildManifest of the working directory
+		if self._manifest==None:
+			start=time.time()
+			self._manifest=BuildManifest(os.path.join(self.output_root or os.getcwd(),'build_manifest.dat')).load()
+			self.stats.add_time('manifest',time.time()-start)
+		return self._manifest
+		
+	
+	@property
+	def missing_network(self):
+		# airports of the scenery without a ground network
+		if self._missing_network==None:
+			self.get_airport_list()
+		return self._missing_network
+		
+	
+	@property
+	def done_files(self):
+		# version -> icaos up to date
+		if self._done_files==None:
+			self.check_already_done()
+		return self._done_files
+		
+	
+	@property
+	def apts(self):
+		# version -> icaos to generate
+		if self._apts==None:
+			apts={}
+			for v in self.versions:
+				index=self.index(v)
+				apts[v]=(set(index.eligible) & self.missing_network) - self.done_files[v]
+				if self.shard!=None:
+					apts[v]=set([a for a in apts[v] if shard_of(a,self.shard[1])==self.shard[0]])
+				apts[v]=self.in_region(v,apts[v])
+				self.stats.count('airports',len(index.airports))
+				self.stats.count('known_format',len(index.eligible))
+				self.stats.count('up_to_date',len(self.done_files[v]))
+				self.stats.count('to_process',len(apts[v]))
+			self._apts=apts
+		return self._apts
+		
+		
+	def in_region(self,version,icaos):
+		# the icaos inside self.region, all of them without a region
+		if self.region==None:
+			return icaos
+		selected=self.index(version).grid().query(self.region)
+		print "Airports in region:",len(selected)
+		return icaos & set(selected)
+		
+		
+	def get_airport_list(self):
+		start=time.time()
+		if os.path.isdir(self.scenery_airports)==False:
+			print "Scenery directory",self.scenery_airports,"not found"
+		cache=SceneryCache(self.scenery_airports,os.path.join(os.getcwd(),'scenery_cache.dat'))
+		cache.load()
+		self._missing_network=cache.scan(self.check_groundnet,self.scan_threads)
+		if cache.changed:
+			cache.save()
+		self.stats.add_time('scan',time.time()-start)
+		self.stats.count('missing_network',len(self._missing_network))
+		
+	
+	def select_airports(self,names,pattern=None):
+		# batch mode: the named airports and those matching pattern are generated again,
+		# whether they are up to date or already have a ground network in the scenery
+		matcher=None
+		if pattern!=None:
+			matcher=re.compile(pattern)
+		names=set(names)
+		self._apts={}
+		self._done_files={}
+		for v in self.versions:
+			index=self.index(v)
+			eligible=set(index.eligible)
+			selected=names & eligible
+			if matcher!=None:
+				selected.update([a for a in eligible if matcher.match(a)!=None])
+			for a in sorted(names - eligible):
+				if a in index.airports:
+					print "Airport",a,"does not fit the default",v,"layout"
+				else:
+					print "Airport",a,"not found in",os.path.basename(index.path)
+			self._apts[v]=self.in_region(v,selected)
+			self._done_files[v]=set()
+			self.stats.count('known_format',len(eligible))
+			self.stats.count('to_process',len(self._apts[v]))
+			
+	
+	def parse_all(self):
+		apts=self.apts
+		total=0
+		for v in self.versions:
+			if len(self.versions)>1:
+				print "Format",v
+			print "Airports to be processed:",len(apts[v])
+			if self._missing_network!=None:
+				# batch never scans the scenery
+				print "Airports with missing network:",len(self._missing_network),
+			print "Airports with known format:",len(self.index(v).eligible)
+			print "Airports up to date:",len(self.done_files[v])
+			total+=len(self.apts[v])
+		if total==0:
+			return
+		workers=self.workers or multiprocessing.cpu_count()
+		batches=self.get_batches(workers)
+		params=self.build_params()
+		load_numpy()
+		done=[0]
+		failed=[]
+		
+		def finished(a,v,error):
+			done[0]+=1
+			record_hash=self.index(v).airports[a][5]
+			if error!=None:
+				failed.append(a)
+				self.stats.failures.append((a,error))
+				if not error.startswith(WRITE_ERROR):
+					self.manifest.quarantine(v,a,record_hash,params,error)
+				print "error:",a,error
+			else:
+				self.manifest.update(v,a,record_hash,params)
+				print a, total - done[0],"left"
+				
+		def returned(results):
+			for a,v,error,text in results:
+				finished(a,v,error)
+				
+		if self.profile_dir!=None and os.path.isdir(self.profile_dir)==False:
+			os.makedirs(self.profile_dir)
+		start=time.time()
+		try:
+			for a,v,offset,length in self.run_with_retries(batches,workers,returned):
+				error='timed out or lost %d times' % (RETRIES+1)
+				self.stats.quarantined.append((a,v,[error],self.output_root))
+				finished(a,v,error)
+		finally:
+			self.manifest.save()
+			self.stats.add_time('parse',time.time()-start)
+			self.stats.count('processed',done[0]-len(failed))
+			self.stats.count('failed',len(failed))
+		print "Airports processed:",done[0]-len(failed),"Failed:",len(failed)
+		self.report_quarantine()
+		
+	
+	def run_with_retries(self,batches,workers,returned,render=False):
+		# Runs the batches through run_batches, then retries the airports of the batches
+		# given up one by one on a new pool, RETRIES rounds. Returns the (icao,version,
+		# offset,length) of the airports given up every time.
+		batches=self.run_batches(batches,workers,returned,render)
+		for attempt in range(RETRIES):
+			if len(batches)==0:
+				break
+			batches=[[task] for batch in batches for task in batch]
+			print "Retrying",len(batches),"airports one by one"
+			self.stats.count('retried',len(batches))
+			batches=self.run_batches(batches,workers,returned,render)
+		return [task for batch in batches for task in batch]
+		
+	
+	def run_batches(self,batches,workers,returned,render=False):
+		# Runs the batches on a new pool and calls returned(results) with the (icao,
+		# version,error,xml) of every batch back, the xml being None unless render is set.
+		# batches may be a generator, it is only read while fewer than two batches per
+		# worker are in flight. A batch which is not back AIRPORT_TIMEOUT seconds per
+		# airport after the time it needed to start, plus STRAGGLER_GRACE, is given up,
+		# and so is one whose worker timed out. Returns those batches, the pool is
+		# terminated if any of them is still running.
+		paths=dict([(v,self.data_path(v)) for v in self.versions])
+		start=time.time()
+		pool=multiprocessing.Pool(workers,init_worker,(paths,self.save_tree,self.park_spacing,self.park_distance,self.profile_dir,self.routes,AIRPORT_TIMEOUT,self.output_root))
+		self.stats.add_time('pool_start',time.time()-start)
+		self.stats.counts['workers']=workers
+		back=Queue.Queue()
+		in_flight={}   # batch number -> (batch,deadline)
+		given_up=[]
+		hung=False
+		todo=iter(batches)
+		more=True
+		n=0
+		try:
+			while more or len(in_flight)>0:
+				while more and len(in_flight)<workers*2:
+					batch=next(todo,None)
+					if batch==None:
+						more=False
+						break
+					pool.apply_async(parse_batch,(batch,render),callback=lambda result,n=n: back.put((n,result)))
+					in_flight[n]=(batch,time.time()+2*AIRPORT_TIMEOUT*len(batch)+STRAGGLER_GRACE)
+					n+=1
+				try:
+					k,(results,stats)=back.get(True,1.0)
+				except Queue.Empty:
+					now=time.time()
+					for k in [k for k in in_flight if in_flight[k][1]<now]:
+						# the worker died or hangs where the alarm cannot stop it
+						batch=in_flight.pop(k)[0]
+						print "Batch of",len(batch),"airports lost, starting with",batch[0][0]
+						self.stats.count('lost_batches')
+						given_up.append(batch)
+						hung=True
+					continue
+				if k not in in_flight:
+					# back after it was given up
+					continue
+				batch=in_flight.pop(k)[0]
+				self.stats.merge(stats)
+				if len(results)>0 and results[0][2]==TIMEOUT_ERROR:
+					self.stats.count('timed_out_batches')
+					given_up.append(batch)
+					continue
+				returned(results)
+			pool.close()
+		except:
+			# interrupted, or printing the progress failed
+			pool.terminate()
+			raise
+		finally:
+			if hung:
+				pool.terminate()
+			pool.join()
+		return given_up
+		
+	
+	def sweep(self,variants):
+		# every selected airport is generated with every (park_spacing,park_distance) of
+		# variants, the records are read once. The manifest is left alone.
+		total=sum([len(self.apts[v]) for v in self.versions])*len(variants)
+		print "Airports to be processed:",sum([len(self.apts[v]) for v in self.versions]),"Variants:",len(variants)
+		if total==0:
+			return
+		workers=self.workers or multiprocessing.cpu_count()
+		batches=self.get_batches(workers)
+		load_numpy()
+		hh=0
+		failed=0
+		paths=dict([(v,self.data_path(v)) for v in self.versions])
+		start=time.time()
+		pool=multiprocessing.Pool(workers,init_worker,(paths,self.save_tree,self.park_spacing,self.park_distance,None,self.routes))
+		self.stats.add_time('pool_start',time.time()-start)
+		self.stats.counts['workers']=workers
+		start=time.time()
+		try:
+			for results,stats in pool.imap_unordered(sweep_batch,[(batch,variants) for batch in batches]):
+				self.stats.merge(stats)
+				for a,v,variant,error in results:
+					hh+=1
+					if error!=None:
+						failed+=1
+						self.stats.failures.append((a,error))
+						print "error:",a,"spacing %g distance %g" % variant,error
+					else:
+						print a,"spacing %g distance %g" % variant,total - hh,"left"
+			pool.close()
+		except:
+			pool.terminate()
+			raise
+		finally:
+			pool.join()
+			self.stats.add_time('parse',time.time()-start)
+			self.stats.count('processed',hh-failed)
+			self.stats.count('failed',failed)
+		for variant in variants:
+			print "spacing %g distance %g ->" % variant,sweep_root(variant)
+		print "Networks generated:",hh-failed,"Failed:",failed
+		self.report_quarantine()
+		
+	
+	def merge_shards(self,n):
+		# Checks that every airport all would generate is in exactly one of the n shard
+		# manifests, the one of its shard, recorded from its current record, then copies
+		# the shard output trees into the working directory and merges the manifests.
+		# Returns False without merging anything when a check fails.
+		params=self.build_params()
+		manifests=[]
+		for k in range(n):
+			path=os.path.join(shard_root(k,n),'build_manifest.dat')
+			if os.path.exists(path)==False:
+				print "Shard",k,"of",n,"has no manifest",path
+				return False
+			manifests.append(BuildManifest(path).load())
+		problems=0
+		for v in self.versions:
+			index=self.index(v)
+			expected=set(index.eligible) & self.missing_network
+			if self.region!=None:
+				expected&=set(index.grid().query(self.region))
+			owners={}
+			for k in range(n):
+				for a in manifests[k].airports[v].keys()+manifests[k].failed[v].keys():
+					owners.setdefault(a,[]).append(k)
+			for a in sorted(expected | set(owners)):
+				found=owners.get(a,[])
+				record_hash=index.airports[a][5] if a in index.airports else None
+				if len(found)==0:
+					error='in no shard'
+				elif len(found)>1:
+					error='in shards %s' % ','.join(map(str,found))
+				elif found[0]!=shard_of(a,n):
+					error='in shard %d instead of %d' % (found[0],shard_of(a,n))
+				elif a not in expected:
+					error='not to be generated'
+				elif not (manifests[found[0]].is_current(v,a,record_hash,params) or manifests[found[0]].is_quarantined(v,a,record_hash,params)):
+					error='generated from another record or with other parameters'
+				else:
+					continue
+				problems+=1
+				print "error:",a,v,error
+		if problems>0:
+			print "Shards not merged,",problems,"problems"
+			return False
+		writer=OutputWriter()
+		writes=[]
+		for k in range(n):
+			root=shard_root(k,n)
+			for v in self.versions:
+				for a in manifests[k].airports[v]:
+					for suffix in ('.groundnet.xml','.routes.json'):
+						src=network_path(a,v,self.save_tree,suffix,root)
+						if suffix=='.groundnet.xml' or os.path.exists(src):
+							fr=open(src,'rb')
+							writes.append(writer.submit(network_path(a,v,self.save_tree,suffix),fr.read()))
+							fr.close()
+				self.manifest.airports[v].update(manifests[k].airports[v])
+				self.manifest.failed[v].update(manifests[k].failed[v])
+				for a in manifests[k].airports[v]:
+					self.manifest.failed[v].pop(a,None)
+				for a in manifests[k].failed[v]:
+					self.manifest.airports[v].pop(a,None)
+		written=len([w for w in writes if w.get()])
+		writer.close()
+		self.manifest.save()
+		print "Files merged:",len(writes),"written:",written,"unchanged:",len(writes)-written
+		print "Quarantined:",sum([len(m.failed[v]) for m in manifests for v in self.versions]),"see the quarantine directories of the shards"
+		return True
+		
+	
+	def report_quarantine(self):
+		# the networks failing validation, one line per airport in the quarantine
+		# directory of every output root
+		roots={}
+		for a,v,problems,root in self.stats.quarantined:
+			roots.setdefault(root or os.getcwd(),[]).append((a,v,problems))
+		for root in sorted(roots):
+			path=os.path.join(root,'quarantine','report.txt')
+			if os.path.isdir(os.path.dirname(path))==False:
+				os.makedirs(os.path.dirname(path))
+			fw=open(path,'wb')
+			for a,v,problems in sorted(roots[root]):
+				fw.write('%s %d: %s\n' % (a,v,'; '.join(problems)))
+			fw.close()
+			print "Airports quarantined:",len(roots[root]),"listed in",path
+		
+	
+	def stream_all(self):
+		# reader -> classifier -> geometry and xml in the workers -> writer thread. At most
+		# two batches per worker are in flight, so memory does not grow with the data file.
+		# Batches run under the same timeouts and retries as in parse_all.
+		# the scenery is scanned before the workers start
+		self.manifest
+		self.missing_network
+		load_numpy()
+		workers=self.workers or multiprocessing.cpu_count()
+		chunk=self.chunk_size or STREAM_CHUNK
+		if self.profile_dir!=None and os.path.isdir(self.profile_dir)==False:
+			os.makedirs(self.profile_dir)
+		writer=NetworkWriter(self,workers*2)
+		writer.start()
+		
+		def batches():
+			batch=[]
+			for task in self.stream_tasks():
+				writer.hashes[task[:2]]=task[4]
+				batch.append(task[:4])
+				if len(batch)==chunk:
+					yield batch
+					batch=[]
+			if len(batch)>0:
+				yield batch
+				
+		start=time.time()
+		try:
+			for a,v,offset,length in self.run_with_retries(batches(),workers,writer.put,True):
+				error='timed out or lost %d times' % (RETRIES+1)
+				self.stats.quarantined.append((a,v,[error],self.output_root))
+				writer.put([(a,v,error,None)])
+		finally:
+			writer.results.put(None)
+			writer.join()
+			self.manifest.save()
+			self.stats.add_time('parse',time.time()-start)
+			self.stats.count('processed',writer.processed)
+			self.stats.count('failed',writer.failed)
+		print "Airports processed:",writer.processed,"Failed:",writer.failed
+		self.report_quarantine()
+		
+	
+	def serve(self,address,cache_size):
+		# address is a (host,port) tuple or the path of a unix socket
+		service=GroundnetService(self,cache_size)
+		if isinstance(address,tuple):
+			server=ThreadingHTTPServer(address,ServiceHandler)
+			print "Serving on http://%s:%d/" % address
+		else:
+			if os.path.exists(address):
+				os.remove(address)
+			server=ThreadingUnixServer(address,ServiceHandler)
+			print "Serving on",address
+		server.service=service
+		try:
+			server.serve_forever()
+		except KeyboardInterrupt:
+			pass
+		finally:
+			server.server_close()
+			service.close()
+			if not isinstance(address,tuple):
+				os.remove(address)
+		
+	
+	def stream_tasks(self):
+		# classifies the records while reading the data files, the index is only
+		# rebuilt when the data file changed
+		params=self.build_params()
+		for v in self.versions:
+			index=AptIndex(self.data_path(v),v)
+			rebuild=index.check()==False
+			if rebuild:
+				print "Indexing",os.path.basename(index.path)
+				records=index.scan()
+			else:
+				records=index.records
+			flag=format_flag(v)
+			seen=set()
+			scanned=[]
+			for rec in records:
+				if rebuild:
+					scanned.append(rec)
+				a=rec[0]
+				if rec[3] & flag==0 or a in seen:
+					continue
+				seen.add(a)
+				self.stats.count('known_format')
+				if self.region!=None and (rec[6]==None or not self.region.contains(rec[6][0],rec[6][1])):
+					continue
+				if a not in self.missing_network:
+					continue
+				if self.shard!=None and shard_of(a,self.shard[1])!=self.shard[0]:
+					continue
+				if self.manifest.is_current(v,a,rec[5],params):
+					self.stats.count('up_to_date')
+					continue
+				if self.manifest.is_quarantined(v,a,rec[5],params):
+					self.stats.count('still_quarantined')
+					continue
+				yield (a,v,rec[1],rec[2],rec[5])
+			if rebuild:
+				index.set_records(index.source,scanned)
+				index.save()
+		
+	
+	def get_batches(self,workers):
+		# airports in file order, split so that every worker gets several batches
+		tasks=[]
+		for v in self.versions:
+			index=self.index(v)
+			for a in index.eligible:
+				if a in self.apts[v]:
+					rec=index.airports[a]
+					tasks.append((a,v,rec[1],rec[2]))
+		chunk=self.chunk_size or max(1,min(64,len(tasks)/(workers*4)))
+		return [tasks[i:i+chunk] for i in range(0,len(tasks),chunk)]
+		
+			
+	def parse_airport(self,a):
+		start=time.time()
+		index=AptIndex(self.data_path(),self.version)
+		# a gzip file has no random access before its seek points are known
+		index.load(build=index.compressed)
+		content=index.get_record(a)
+		self.stats.add_time('index',time.time()-start)
+		if content==None:
+			print "Airport",a,"not found in",os.path.basename(index.path)
+			return
+		print a
+		results=parse_records([(a,self.version,content)],self.save_tree,self.park_spacing,self.park_distance,self.stats,routes=self.routes)
+		error=results[0][2]
+		if error!=None:
+			self.stats.failures.append((a,error))
+			self.stats.count('failed')
+			print "error:",a,error
+			self.report_quarantine()
+			return
+		self.stats.count('processed')
+		manifest=BuildManifest(os.path.join(os.getcwd(),'build_manifest.dat')).load()
+		manifest.update(self.version,a,hashlib.sha1("".join(content)).hexdigest(),self.build_params())
+		manifest.save()
+		
+	
+	def data_path(self,version=None):
+		# apt.dat is used when it is there, apt.dat.gz otherwise
+		if (version or self.version)==850:
+			path=os.path.join(os.getcwd(),'apt850.dat')
+		else:
+			path=os.path.join(os.getcwd(),'apt.dat')
+		if os.path.exists(path)==False and os.path.exists(path+'.gz'):
+			return path+'.gz'
+		return path
+
+
+	def load_index(self,version):
+		start=time.time()
+		self.indexes[version]=AptIndex(self.data_path(version),version).load()
+		self.stats.add_time('index',time.time()-start)
+		
+		
+	def check_already_done(self):
+		# airports generated from the same record with the same parameters are up to date
+		# and those which failed with them are left in quarantine
+		params=self.build_params()
+		done={}
+		for v in self.versions:
+			index=self.index(v)
+			done[v]=set()
+			for a in index.eligible:
+				record_hash=index.airports[a][5]
+				if self.manifest.is_current(v,a,record_hash,params):
+					done[v].add(a)
+				elif self.manifest.is_quarantined(v,a,record_hash,params):
+					done[v].add(a)
+					self.stats.count('still_quarantined')
+		self._done_files=done
+				
+	
+	def build_params(self):
+		params=(GENERATOR_VERSION,self.park_spacing,self.park_distance,self.save_tree)
+		if self.routes:
+			params+=('routes',)
+		return params
+		
+		
+		
+	def check_groundnet(self,dirname,filenames):
+		# airports of one scenery directory which have files but no ground network
+		missing=set()
+		if dirname.find(".svn")!=-1:
+			return missing
+		names=set(filenames)
+		for filename in filenames:
+			if XML_RE.search(filename)!=None:
+				tokens=filename.split(".")
+				if tokens[0]+".groundnet.xml" in names:
+					continue
+				if tokens[0]+".parking.xml" in names:
+					continue
+				else:
+					missing.add(tokens[0])
+		return missing
+	
+		
+# Typed rows of an airport record, Parser fills them once per airport
+
+class RunwayRow(object):
+	# row 10 (810 runway or taxiway segment, centered) or row 100 (850 runway, both ends)
+	__slots__=('code','lat','lon','number','heading','length','width')
+	def __init__(self,code,lat,lon,number,heading,length,width):
+		self.code=code
+		self.lat=lat
+		self.lon=lon
+		self.number=number
+		self.heading=heading  # true heading in degrees
+		self.length=length    # meters
+		self.width=width      # meters
+		
+		
+def parse_runway_810(tokens):
+	return RunwayRow(10,float(tokens[1]),float(tokens[2]),tokens[3],float(tokens[4]),float(tokens[5]) * FEET_TO_METER,float(tokens[8]) * FEET_TO_METER)
+	
+	
+def parse_runway_850(tokens):
+	lat1=float(tokens[9])
+	lon1=float(tokens[10])
+	lat2=float(tokens[18])
+	lon2=float(tokens[19])
+	lat1_r=math.radians(lat1)
+	lat2_r=math.radians(lat2)
+	dlon=math.radians(lon2-lon1)
+	heading=math.degrees(math.atan2(math.sin(dlon)*math.cos(lat2_r),math.cos(lat1_r)*math.sin(lat2_r)-math.sin(lat1_r)*math.cos(lat2_r)*math.cos(dlon)))
+	dist=2*math.asin(math.sqrt(math.sin((lat2_r-lat1_r)/2)**2+math.cos(lat1_r)*math.cos(lat2_r)*math.sin(dlon/2)**2))
+	length=dist / NM_TO_RAD / METER_TO_NM
+	if abs(lon1-lon2)>180:
+		lon=midpoint_lon(lon1,lon2)
+	else:
+		lon=(lon1+lon2)/2
+	return RunwayRow(100,(lat1+lat2)/2,lon,tokens[8]+'/'+tokens[17],math.fmod(heading+360.0,360.0),length,float(tokens[1]))
+	
+	
+# Longitude halfway between two longitudes on opposite sides of the antimeridian
+def midpoint_lon(lon1,lon2):
+	lon=(lon1+lon2)/2+180
+	if lon>=180:
+		lon-=360
+	return lon
+	
+	
+class PavementNode(object):
+	# rows 111-116, the bezier rows 112, 114 and 116 also carry a control point
+	__slots__=('code','lat','lon','bezier_lat','bezier_lon')
+	def __init__(self,code,lat,lon,bezier_lat=None,bezier_lon=None):
+		self.code=code
+		self.lat=lat
+		self.lon=lon
+		self.bezier_lat=bezier_lat
+		self.bezier_lon=bezier_lon
+		
+		
+def parse_pavement_node(tokens):
+	code=int(tokens[0])
+	if code % 2==0:
+		return PavementNode(code,float(tokens[1]),float(tokens[2]),float(tokens[3]),float(tokens[4]))
+	return PavementNode(code,float(tokens[1]),float(tokens[2]))
+	
+	
+class Frequency(object):
+	# rows 50-56
+	__slots__=('code','freq','name')
+	def __init__(self,code,freq,name):
+		self.code=code
+		self.freq=freq  # in 10 kHz units, as written in apt.dat
+		self.name=name
+		
+		
+def parse_frequency(tokens):
+	return Frequency(int(tokens[0]),int(tokens[1])," ".join(tokens[2:]))
+	
+	
+class TaxiNode(object):
+	__slots__=('lat','lon','index')
+	def __init__(self,lat,lon,index):
+		self.lat=lat
+		self.lon=lon
+		self.index=index
+		
+		
+NODE_RUNWAY=1
+NODE_HOLD=2
+NODE_PARKING=4
+
+
+# Taxi network of one airport in arrays. Nodes and arcs are added in file order,
+# freeze() then builds the CSR adjacency: the neighbours of node i are
+# targets[offsets[i]:offsets[i+1]], with the arc lengths in meters in lengths.
+class TaxiGraph:
+	def __init__(self):
+		self.index=array.array('i')   # groundnet index of the node, the parking index for parkings
+		self.lat=array.array('d')
+		self.lon=array.array('d')
+		self.flags=array.array('B')
+		self.begin=array.array('i')   # arcs, each one is written in both directions
+		self.end=array.array('i')
+		self.offsets=None
+		
+	
+	def add_node(self,index,lat,lon,flags=0):
+		self.index.append(index)
+		self.lat.append(lat)
+		self.lon.append(lon)
+		self.flags.append(flags)
+		return len(self.index)-1
+		
+	
+	def add_arc(self,begin,end):
+		self.begin.append(begin)
+		self.end.append(end)
+		
+	
+	def freeze(self):
+		n=len(self.index)
+		degree=[0]*(n+1)
+		for k in range(len(self.begin)):
+			degree[self.begin[k]+1]+=1
+			degree[self.end[k]+1]+=1
+		for i in range(n):
+			degree[i+1]+=degree[i]
+		self.offsets=array.array('i',degree)
+		fill=list(degree[:n])
+		self.targets=array.array('i',[0]*degree[n])
+		self.lengths=array.array('d',[0.0]*degree[n])
+		for k in range(len(self.begin)):
+			a=self.begin[k]
+			b=self.end[k]
+			length=self.distance(a,b)
+			self.targets[fill[a]]=b
+			self.lengths[fill[a]]=length
+			fill[a]+=1
+			self.targets[fill[b]]=a
+			self.lengths[fill[b]]=length
+			fill[b]+=1
+			
+	
+	def distance(self,a,b):
+		return great_circle(self.lat[a],self.lon[a],self.lat[b],self.lon[b])
+		
+	
+	def nodes(self,flag):
+		return [i for i in range(len(self.flags)) if self.flags[i] & flag]
+		
+	
+	def shortest_paths(self,source):
+		# Dijkstra over the CSR arrays, returns the distance and previous node of every node
+		if self.offsets==None:
+			self.freeze()
+		n=len(self.index)
+		dist=[None]*n
+		prev=[-1]*n
+		dist[source]=0.0
+		heap=[(0.0,source)]
+		while heap:
+			d,a=heapq.heappop(heap)
+			if d>dist[a]:
+				continue
+			for k in range(self.offsets[a],self.offsets[a+1]):
+				b=self.targets[k]
+				nd=d+self.lengths[k]
+				if dist[b]==None or nd<dist[b]:
+					dist[b]=nd
+					prev[b]=a
+					heapq.heappush(heap,(nd,b))
+		return dist,prev
+		
+	
+	def routes(self):
+		# shortest route from every parking to every hold point:
+		# (parking index,hold node index,length,groundnet indexes along the route)
+		holds=self.nodes(NODE_HOLD)
+		routes=[]
+		for p in self.nodes(NODE_PARKING):
+			dist,prev=self.shortest_paths(p)
+			for h in holds:
+				if dist[h]==None:
+					continue
+				path=[]
+				k=h
+				while k!=-1:
+					path.append(self.index[k])
+					k=prev[k]
+				path.reverse()
+				routes.append((self.index[p],self.index[h],dist[h],path))
+		return routes
+		
+	
+	def write_nodes(self,out):
+		write=out.write
+		for i in range(len(self.index)):
+			flags=self.flags[i]
+			if flags & NODE_PARKING:
+				continue
+			onrunway='0'
+			hold='none'
+			if flags & NODE_RUNWAY:
+				onrunway='1'
+			if flags & NODE_HOLD:
+				hold='normal'
+			write(NODE_TEMPLATE % ((self.index[i],)+format_coord(self.lat[i],self.lon[i])+(onrunway,hold)))
+			
+	
+	def write_arcs(self,out):
+		write=out.write
+		index=self.index
+		for k in range(len(self.begin)):
+			begin=index[self.begin[k]]
+			end=index[self.end[k]]
+			write(ARC_PAIR_TEMPLATE % (begin,end,end,begin))
+			
+		
+# Comma separated numbers of an option, like 50,60
+def float_list(text):
+	return [float(x) for x in text.split(',')]
+	
+	
+# ICAO codes listed in a file, or on stdin for -, separated by white space. # starts a comment.
+def read_names(path):
+	if path=='-':
+		fr=sys.stdin
+	else:
+		fr=open(path,'r')
+	names=[]
+	for line in fr:
+		names.extend(line.split('#')[0].upper().split())
+	if fr!=sys.stdin:
+		fr.close()
+	return names
+	
+	
+# Flags of the nodes of the default layouts, by groundnet index
+def node_flags(index,runway_nodes,hold_nodes):
+	flags=0
+	if index in runway_nodes:
+		flags|=NODE_RUNWAY
+	if index in hold_nodes:
+		flags|=NODE_HOLD
+	return flags
+	
+	
+# Templates of the generated groundnet.xml elements
+XML_HEADER='<?xml version="1.0"?>\n<groundnet>\n<version>1</version>\n<frequencies>\n'
+FREQUENCY_TEMPLATE='\t<%s>%05d</%s>\n'
+PARKING_TEMPLATE='''
+		<Parking index="%d"
+			 type="gate"
+			 name="Gate"
+			 number="%d"
+			 lat="%s%d %s"
+			 lon="%s%d %s"
+			 heading="%s"
+			 radius="28"
+			 airlineCodes="" />'''
+NODE_TEMPLATE='\t<node index="%d" lat="%s%d %s" lon="%s%d %s" isOnRunway="%s" holdPointType="%s" />\n'
+ARC_PAIR_TEMPLATE='\t<arc begin="%d" end="%d" isPushBackRoute="0" name="" />\n\t<arc begin="%d" end="%d" isPushBackRoute="0" name="" />\n'
+
+
+# Hemisphere, degrees and minutes of a coordinate pair, as filled into the lat="%s%d %s" lon="%s%d %s" templates
+def format_coord(lat,lon):
+	if lat>0:
+		lat_hemi='N'
+	else:
+		lat_hemi='S'
+	if lon>0:
+		lon_hemi='E'
+	else:
+		lon_hemi='W'
+	lat_min,lat_deg=math.modf(lat)
+	lon_min,lon_deg=math.modf(lon)
+	return (lat_hemi,int(math.fabs(lat_deg)),math.fabs(lat_min) *60,lon_hemi,int(math.fabs(lon_deg)),math.fabs(lon_min) *60)
+	
+	
+RUNWAY_NODES_810=(11,14,17)
+HOLD_NODES_810=(10,13,16)
+RUNWAY_NODES_850=(9,15,17)
+HOLD_NODES_850=(10,14,16)
+FREQUENCY_TAGS={50:'AWOS',51:'UNICOM',52:'CLEARANCE',53:'GROUND',54:'TOWER',55:'APPROACH',56:'APPROACH'}
+LAYOUT_NODE_CODES=(111,112,113,115)  # 850 rows the default layout is built from
+
+
+METER_TO_NM=0.0005399568034557235
+NM_TO_RAD=0.00029088820866572159
+FEET_TO_METER=0.3048
+PARKING_COUNT=9      # parking positions generated along the long taxiway
+GEO_TOLERANCE=1e-9   # degrees, largest allowed difference between the numpy and the scalar results
+
+
+# Destination point dist radians away from lat,lon on the given heading.
+# The formula takes longitudes positive to the west, callers swap the
+# longitudes of the two directions.
+def destination(lat,lon,heading,dist):
+	lat2=math.degrees(math.asin(math.sin(math.radians(lat))*math.cos(dist)+math.cos(math.radians(lat))*math.sin(dist)*math.cos(math.radians(heading))))
+	lon2=math.degrees(math.fmod(math.radians(lon)-math.asin(math.sin(math.radians(heading))*math.sin(dist)/math.cos(math.radians(lat2))) + math.pi,2*math.pi)-math.pi)
+	return lat2,lon2
+	
+	
+def destination_array(lat,lon,heading,dist):
+	lat_r=numpy.radians(lat)
+	heading_r=numpy.radians(heading)
+	sin_dist=numpy.sin(dist)
+	lat2=numpy.degrees(numpy.arcsin(numpy.sin(lat_r)*numpy.cos(dist)+numpy.cos(lat_r)*sin_dist*numpy.cos(heading_r)))
+	lon2=numpy.degrees(numpy.fmod(numpy.radians(lon)-numpy.arcsin(numpy.sin(heading_r)*sin_dist/numpy.cos(numpy.radians(lat2))) + math.pi,2*math.pi)-math.pi)
+	return lat2,lon2
+	
+	
+def back_heading(heading):
+	heading_back=heading+180.0
+	if heading_back>=360.0:
+		heading_back=heading_back-360.0
+	return heading_back
+	
+	
+# End points of taxiway segments given their centers, headings and half lengths in meters.
+# Returns (lat1,lon_end,lat_end,lon1) for each segment.
+def taxiway_endpoints(lat,lon,heading,length):
+	if numpy!=None and len(lat)>0:
+		lat=numpy.array(lat,dtype=float)
+		lon=numpy.array(lon,dtype=float)
+		heading=numpy.array(heading,dtype=float)
+		heading_back=heading+180.0
+		heading_back=numpy.where(heading_back>=360.0,heading_back-360.0,heading_back)
+		length_rad=numpy.array(length,dtype=float) * METER_TO_NM * NM_TO_RAD
+		lat1,lon1=destination_array(lat,lon,heading,length_rad)
+		lat_end,lon_end=destination_array(lat,lon,heading_back,length_rad)
+		return zip(lat1.tolist(),lon_end.tolist(),lat_end.tolist(),lon1.tolist())
+	ends=[]
+	for i in range(len(lat)):
+		length_rad= length[i] * METER_TO_NM * NM_TO_RAD
+		lat1,lon1=destination(lat[i],lon[i],heading[i],length_rad)
+		lat_end,lon_end=destination(lat[i],lon[i],back_heading(heading[i]),length_rad)
+		ends.append((lat1,lon_end,lat_end,lon1))
+	return ends
+	
+	
+# Parking positions beside the taxiway starting at each origin. Returns for every
+# origin a list of PARKING_COUNT (taxiway lat,lon,parking lat,lon) and the parking heading.
+def parking_positions(lat,lon,heading,park_spacing,park_distance):
+	if numpy!=None and len(lat)>0:
+		lat=numpy.array(lat,dtype=float)[:,None]
+		lon=numpy.array(lon,dtype=float)[:,None]
+		heading=numpy.array(heading,dtype=float)[:,None]
+		heading_back=heading+180.0
+		heading_back=numpy.where(heading_back>=360.0,heading_back-360.0,heading_back)
+		heading2=heading+90
+		heading2=numpy.where(heading2>=360,heading2-360,heading2)
+		heading2_back=heading2 +180
+		heading2_back=numpy.where(heading2_back>=360,heading2_back-360,heading2_back)
+		length_rad= park_spacing * numpy.arange(1,PARKING_COUNT+1) * METER_TO_NM * NM_TO_RAD
+		length_rad2=park_distance * METER_TO_NM * NM_TO_RAD
+		lat2,lon2=destination_array(lat,lon,heading,length_rad)
+		lat2_end,lon2_end=destination_array(lat,lon,heading_back,length_rad)
+		lat3,lon3=destination_array(lat2,lon2_end,heading2,length_rad2)
+		lat3_end,lon3_end=destination_array(lat2,lon2_end,heading2_back,length_rad2)
+		positions=numpy.dstack((lat2,lon2_end,lat3,lon3_end)).tolist()
+		return [(map(tuple,positions[i]),h) for i,h in enumerate(heading2_back[:,0].tolist())]
+	parking=[]
+	for k in range(len(lat)):
+		heading_back=back_heading(heading[k])
+		length_rad2=park_distance * METER_TO_NM * NM_TO_RAD
+		heading2=heading[k]+90
+		if(heading2>=360):
+			heading2=heading2-360
+		heading2_back=heading2 +180
+		if heading2_back >=360:
+			heading2_back=heading2_back-360
+		positions=[]
+		for i in range(1,PARKING_COUNT+1):
+			length_rad= park_spacing * i * METER_TO_NM * NM_TO_RAD
+			lat2,lon2=destination(lat[k],lon[k],heading[k],length_rad)
+			lat2_end,lon2_end=destination(lat[k],lon[k],heading_back,length_rad)
+			lat3,lon3=destination(lat2,lon2_end,heading2,length_rad2)
+			lat3_end,lon3_end=destination(lat2,lon2_end,heading2_back,length_rad2)
+			positions.append((lat2,lon2_end,lat3,lon3_end))
+		parking.append((positions,heading2_back))
+	return parking
+	
+	
+# Computes the taxiway end points and parking positions of a batch of
+# parsers in one call and hands every parser its share of the results
+def compute_geometry(parsers,park_spacing,park_distance):
+	compute_ends(parsers)
+	compute_parking(parsers,park_spacing,park_distance)
+	
+	
+# The taxiway ends only depend on the records, compute_parking on the parking layout too
+def compute_ends(parsers):
+	taxiways=[]
+	for p in parsers:
+		taxiways.extend(p.taxiways)
+	ends=taxiway_endpoints([t.lat for t in taxiways],[t.lon for t in taxiways],[t.heading for t in taxiways],[t.length/2 for t in taxiways])
+	i=0
+	for p in parsers:
+		p.ends=ends[i:i+len(p.taxiways)]
+		i+=len(p.taxiways)
+		
+		
+def compute_parking(parsers,park_spacing,park_distance):
+	origins=[]
+	for p in parsers:
+		origins.extend(p.park_origins)
+	parking=parking_positions([o.lat for o in origins],[o.lon for o in origins],[o.heading for o in origins],park_spacing,park_distance)
+	k=0
+	for p in parsers:
+		p.parking=parking[k:k+len(p.park_origins)]
+		k+=len(p.park_origins)
+		
+		
+PARKING_RADIUS=28.0         # meters, as written for every parking
+ARC_LENGTHS=(0.0,5000.0)    # meters, taxiway segments must be longer than the first and at most the second
+ENVELOPE_MARGIN=1000.0      # meters the nodes may lie beyond the ends of the runways
+METER_TO_DEG=180/math.pi/EARTH_RADIUS
+
+# Offset in meters of a point from a runway center, along and across the runway heading
+def runway_offset(lat,lon,runway):
+	dlon=lon-runway.lon
+	if dlon>180:
+		dlon-=360
+	elif dlon<-180:
+		dlon+=360
+	dy=(lat-runway.lat)/METER_TO_DEG
+	dx=dlon*math.cos(math.radians(runway.lat))/METER_TO_DEG
+	h=math.radians(runway.heading)
+	return dx*math.sin(h)+dy*math.cos(h),dx*math.cos(h)-dy*math.sin(h)
+	
+	
+# Geometric checks of the laid out networks of a batch of parsers: arc lengths, overlapping
+# parkings, nodes far from the runways and hold points on a runway. Returns the problems
+# found for every parser, an empty list if the network is valid.
+def validate_networks(parsers):
+	if numpy!=None and len(parsers)>0:
+		return validate_arrays(parsers)
+	problems=[]
+	low,high=ARC_LENGTHS
+	for p in parsers:
+		g=p.graph
+		found=[]
+		for a,b in zip(g.begin,g.end):
+			length=g.distance(a,b)
+			if length<=low or length>high:
+				found.append('arc %d-%d is %.1f m long' % (g.index[a],g.index[b],length))
+		park=g.nodes(NODE_PARKING)
+		for i in range(len(park)):
+			for j in park[i+1:]:
+				gap=g.distance(park[i],j)
+				if gap<2*PARKING_RADIUS:
+					found.append('parkings %d and %d overlap, %.1f m apart' % (g.index[park[i]],g.index[j],gap))
+		if len(p.runways)>0:
+			for i in range(len(g.index)):
+				for r in p.runways:
+					if great_circle(g.lat[i],g.lon[i],r.lat,r.lon)<=r.length/2+ENVELOPE_MARGIN:
+						break
+				else:
+					found.append('node %d outside the runway envelope' % g.index[i])
+		for i in g.nodes(NODE_HOLD):
+			for r in p.runways:
+				along,across=runway_offset(g.lat[i],g.lon[i],r)
+				if abs(along)<=r.length/2 and abs(across)<=r.width/2:
+					found.append('hold point %d on runway %s' % (g.index[i],r.number))
+		problems.append(found)
+	return problems
+	
+	
+# Pairs every item of a group with the items start[owner]..start[owner]+count[owner]-1
+# of another group, for items owned by the airports of a batch
+def owner_pairs(owner,start,count):
+	n=count[owner]
+	first=numpy.cumsum(n)-n
+	a=numpy.repeat(numpy.arange(len(owner)),n)
+	b=numpy.repeat(start[owner]-first,n)+numpy.arange(n.sum())
+	return a,b
+	
+	
+def haversine_array(lat1,lon1,lat2,lon2):
+	lat1=numpy.radians(lat1)
+	lat2=numpy.radians(lat2)
+	h=numpy.sin((lat2-lat1)/2)**2+numpy.cos(lat1)*numpy.cos(lat2)*numpy.sin(numpy.radians(lon2-lon1)/2)**2
+	return 2*EARTH_RADIUS*numpy.arcsin(numpy.minimum(1.0,numpy.sqrt(h)))
+	
+	
+# validate_networks with the nodes, arcs and runways of all airports in flat arrays
+def validate_arrays(parsers):
+	index=array.array('i')
+	lat=array.array('d')
+	lon=array.array('d')
+	flags=array.array('B')
+	begin=[]
+	end=[]
+	node_start=[]
+	runways=[]
+	runway_start=[]
+	for p in parsers:
+		g=p.graph
+		node_start.append(len(index))
+		begin.append(numpy.frombuffer(g.begin,dtype=numpy.int32)+len(index))
+		end.append(numpy.frombuffer(g.end,dtype=numpy.int32)+len(index))
+		index.extend(g.index)
+		lat.extend(g.lat)
+		lon.extend(g.lon)
+		flags.extend(g.flags)
+		runway_start.append(len(runways))
+		runways.extend(p.runways)
+	index=numpy.frombuffer(index,dtype=numpy.int32)
+	lat=numpy.frombuffer(lat,dtype=float)
+	lon=numpy.frombuffer(lon,dtype=float)
+	flags=numpy.frombuffer(flags,dtype=numpy.uint8)
+	node_start=numpy.array(node_start+[len(index)])
+	node_count=numpy.diff(node_start)
+	owner=numpy.repeat(numpy.arange(len(parsers)),node_count)
+	runway_start=numpy.array(runway_start+[len(runways)])
+	runway_count=numpy.diff(runway_start)
+	r_lat=numpy.array([r.lat for r in runways],dtype=float)
+	r_lon=numpy.array([r.lon for r in runways],dtype=float)
+	r_heading=numpy.radians([r.heading for r in runways])
+	r_length=numpy.array([r.length for r in runways],dtype=float)
+	r_width=numpy.array([r.width for r in runways],dtype=float)
+	problems=[[] for p in parsers]
+	
+	begin=numpy.concatenate(begin)
+	end=numpy.concatenate(end)
+	lengths=haversine_array(lat[begin],lon[begin],lat[end],lon[end])
+	low,high=ARC_LENGTHS
+	for k in numpy.nonzero((lengths<=low)|(lengths>high))[0].tolist():
+		problems[owner[begin[k]]].append('arc %d-%d is %.1f m long' % (index[begin[k]],index[end[k]],lengths[k]))
+		
+	# the parkings of an airport follow each other in its graph
+	park=numpy.nonzero(flags & NODE_PARKING)[0]
+	park_owner=owner[park]
+	park_start=numpy.searchsorted(park_owner,numpy.arange(len(parsers)))
+	park_count=numpy.bincount(park_owner,minlength=len(parsers))
+	a,b=owner_pairs(park_owner,park_start,park_count)
+	keep=a<b
+	a=park[a[keep]]
+	b=park[b[keep]]
+	gaps=haversine_array(lat[a],lon[a],lat[b],lon[b])
+	for k in numpy.nonzero(gaps<2*PARKING_RADIUS)[0].tolist():
+		problems[owner[a[k]]].append('parkings %d and %d overlap, %.1f m apart' % (index[a[k]],index[b[k]],gaps[k]))
+		
+	# a node is inside the envelope when it is near enough to any of the runways
+	a,b=owner_pairs(owner,runway_start[:-1],runway_count)
+	near=haversine_array(lat[a],lon[a],r_lat[b],r_lon[b])<=r_length[b]/2+ENVELOPE_MARGIN
+	inside=numpy.bincount(a,weights=near,minlength=len(index))>0
+	for i in numpy.nonzero((inside==False)&(runway_count[owner]>0))[0].tolist():
+		problems[owner[i]].append('node %d outside the runway envelope' % index[i])
+		
+	holds=numpy.nonzero(flags & NODE_HOLD)[0]
+	a,b=owner_pairs(owner[holds],runway_start[:-1],runway_count)
+	a=holds[a]
+	dlon=lon[a]-r_lon[b]
+	dlon=numpy.where(dlon>180,dlon-360,numpy.where(dlon<-180,dlon+360,dlon))
+	dy=(lat[a]-r_lat[b])/METER_TO_DEG
+	dx=dlon*numpy.cos(numpy.radians(r_lat[b]))/METER_TO_DEG
+	along=dx*numpy.sin(r_heading[b])+dy*numpy.cos(r_heading[b])
+	across=dx*numpy.cos(r_heading[b])-dy*numpy.sin(r_heading[b])
+	for k in numpy.nonzero((numpy.abs(along)<=r_length[b]/2)&(numpy.abs(across)<=r_width[b]/2))[0].tolist():
+		problems[owner[a[k]]].append('hold point %d on runway %s' % (index[a[k]],runways[b[k]].number))
+	return problems
+	
+	
+# State of a pool worker, set up once by init_worker
+worker={}
+
+TIMEOUT_ERROR='timed out'
+# Failed writes of the output files, the next run tries the airport again instead of
+# keeping it quarantined
+WRITE_ERROR='write failed'
+
+# Raised by the alarm of a worker out of time, not an Exception so that the handlers
+# of single airports let it through to parse_batch
+class AirportTimeout(BaseException):
+	pass
+	
+	
+def alarm(signum,frame):
+	raise AirportTimeout(TIMEOUT_ERROR)
+	
+	
+def init_worker(paths,tree,park_spacing,park_distance,profile_dir=None,routes=False,timeout=None,root=None):
+	signal.signal(signal.SIGINT,signal.SIG_IGN)
+	signal.signal(signal.SIGALRM,alarm)
+	worker['timeout']=timeout   # seconds per airport of a batch
+	worker['root']=root         # directory of the output trees, None for the working directory
+	# paths maps every version of the run to its data file
+	worker['data']={}
+	for version in paths:
+		worker['data'][version]=open_data(paths[version])
+	worker['args']=(tree,park_spacing,park_distance)
+	worker['routes']=routes
+	worker['writer']=OutputWriter()
+	worker['profile']=None
+	if profile_dir!=None:
+		worker['profile']=cProfile.Profile()
+		worker['profile_path']=os.path.join(profile_dir,'worker-%d.prof' % os.getpid())
+		if tracemalloc!=None:
+			tracemalloc.start()
+	
+	
+def sweep_batch(args):
+	batch,variants=args
+	data=worker['data']
+	tree=worker['args'][0]
+	stats=Stats()
+	records=[(a,v,data[v][offset:offset+length].splitlines(True)) for a,v,offset,length in batch]
+	return sweep_records(records,tree,variants,stats,worker['routes'],worker['writer']),stats.dump()
+	
+	
+def parse_batch(batch,render=False):
+	# With a timeout the whole batch is given up when it takes longer than that per
+	# airport, the parent then retries the airports one by one. With render the xml
+	# is returned instead of written.
+	if worker['timeout']!=None:
+		signal.setitimer(signal.ITIMER_REAL,worker['timeout']*len(batch))
+	try:
+		if render:
+			return render_batch(batch)
+		return generate_batch(batch)
+	except AirportTimeout:
+		return [(a,v,TIMEOUT_ERROR,None) for a,v,offset,length in batch],Stats().dump()
+	except Exception, e:
+		return [(a,v,error_text(e),None) for a,v,offset,length in batch],Stats().dump()
+	finally:
+		signal.setitimer(signal.ITIMER_REAL,0)
 		
-	def get_airport_list(self):
-		if self.version==850:
-			airport_list='airport_list_850.txt'
-		else:
-			airport_list='airport_list.txt'
-			
+	
+def generate_batch(batch):
+	data=worker['data']
+	tree,park_spacing,park_distance=worker['args']
+	stats=Stats()
+	records=[(a,v,data[v][offset:offset+length].splitlines(True)) for a,v,offset,length in batch]
+	profile=worker['profile']
+	if profile==None:
+		return parse_records(records,tree,park_spacing,park_distance,stats,routes=worker['routes'],writer=worker['writer'],root=worker['root']),stats.dump()
+	profile.enable()
+	try:
+		results=parse_records(records,tree,park_spacing,park_distance,stats,routes=worker['routes'],writer=worker['writer'],root=worker['root'])
+	finally:
+		profile.disable()
+		# the profile holds every batch of this worker so far
+		profile.dump_stats(worker['profile_path'])
+	if tracemalloc!=None:
+		stats.peak_memory=tracemalloc.get_traced_memory()[1]
+	return results,stats.dump()
+	
+	
+def render_batch(batch):
+	tree,park_spacing,park_distance=worker['args']
+	stats=Stats()
+	try:
+		records=[(a,v,worker['data'][v][offset:offset+length].splitlines(True)) for a,v,offset,length in batch]
+		profile=worker['profile']
+		if profile!=None:
+			profile.enable()
 		try:
-			os.stat(os.path.join(os.getcwd(),airport_list))
-		except:
-			os.path.walk(self.scenery_airports,self.check_groundnet,None)
-			fw=open(os.path.join(os.getcwd(),airport_list),'wb')
-			buf="\n".join(self.missing_network)
-			fw.write(buf)
-			fw.close()
-			return
+			results=parse_records(records,tree,park_spacing,park_distance,stats,True,root=worker['root'])
+		finally:
+			if profile!=None:
+				profile.disable()
+				profile.dump_stats(worker['profile_path'])
+		if tracemalloc!=None and profile!=None:
+			stats.peak_memory=tracemalloc.get_traced_memory()[1]
+	except Exception, e:
+		results=[(a,v,error_text(e),None) for a,v,offset,length in batch]
+	return results,stats.dump()
+	
+	
+# Reads, computes and writes a list of (icao,version,record lines), returns (icao,version,error or None,xml)
+# for each airport. Stage times, per airport latencies and warnings go to stats.
+# With render the files are not written and the xml text is returned instead of None.
+# With routes the parking to hold point routes are written next to the files.
+# The files are handed to writer, an OutputWriter, or written in turn without one.
+# root is the directory of the output trees, the working directory by default.
+# Without quarantine networks failing validation are not written anywhere.
+def parse_records(records,tree,park_spacing,park_distance,stats,render=False,routes=False,writer=None,root=None,quarantine=True):
+	results=[]
+	parsers=read_records(records,tree,park_spacing,park_distance,stats,results,routes)
+	start=time.time()
+	compute_geometry(parsers,park_spacing,park_distance)
+	geometry=time.time()-start
+	stats.add_time('geometry',geometry)
+	return results+generate_networks(parsers,geometry,stats,render,writer,root,quarantine)
+	
+	
+# Parsers which read their record, the failures go to results
+def read_records(records,tree,park_spacing,park_distance,stats,results,routes=False):
+	parsers=[]
+	for a,version,content in records:
+		start=time.time()
+		pthread=Parser(a,tree,park_spacing,park_distance,content,version,routes)
+		try:
+			pthread.read()
+		except Exception, e:
+			results.append((a,version,error_text(e),None))
+			continue
+		finally:
+			stats.warnings.extend([(a,w) for w in pthread.warnings])
+			pthread.latency=time.time()-start
+			stats.add_time('read',pthread.latency)
+		parsers.append(pthread)
+	return parsers
+	
+	
+# Lays out, validates and writes or renders the networks of parsers whose geometry is
+# computed, geometry is the time that took. Returns the results as parse_records does.
+def generate_networks(parsers,geometry,stats,render=False,writer=None,root=None,quarantine=True):
+	results=[]
+	start=time.time()
+	laid_out=[]
+	for pthread in parsers:
+		try:
+			pthread.layout()
+		except Exception, e:
+			results.append((pthread.apt,pthread.version,error_text(e),None))
+			continue
+		laid_out.append(pthread)
+	found=validate_networks(laid_out)
+	stats.add_time('validate',time.time()-start)
+	parsers=[]
+	for pthread,problems in zip(laid_out,found):
+		if len(problems)==0:
+			parsers.append(pthread)
+			continue
+		if quarantine:
+			# kept apart for inspection, a failed write of it does not matter
+			stats.quarantined.append((pthread.apt,pthread.version,problems,root))
+			start=time.time()
+			try:
+				write_file(quarantine_path(pthread.apt,pthread.version,root),pthread.serialize())
+			except (IOError,OSError):
+				pass
+			stats.add_time('quarantine',time.time()-start)
+		results.append((pthread.apt,pthread.version,'validation failed: '+'; '.join(problems),None))
+	pending=[]
+	for pthread in parsers:
+		start=time.time()
+		text=None
+		try:
+			if render:
+				text=pthread.serialize()
+			elif writer!=None:
+				pending.append((pthread,start,[writer.submit(path,data) for path,data in pthread.outputs(root)]))
+				continue
+			else:
+				pthread.build(root)
+		except (IOError,OSError), e:
+			results.append((pthread.apt,pthread.version,write_error(e),None))
+			continue
+		except Exception, e:
+			results.append((pthread.apt,pthread.version,error_text(e),None))
+			continue
+		finally:
+			stats.add_time(render and 'serialize' or 'write',time.time()-start)
+		stats.latencies.append(pthread.latency+time.time()-start+geometry/len(laid_out))
+		results.append((pthread.apt,pthread.version,None,text))
+	# the files of the batch are written meanwhile, wait for them
+	for pthread,start,writes in pending:
+		wait=time.time()
+		error=None
+		for w in writes:
+			try:
+				if w.get()==False:
+					stats.count('unchanged')
+			except Exception, e:
+				error=write_error(e)
+		stats.add_time('write_wait',time.time()-wait)
+		if error==None:
+			stats.latencies.append(pthread.latency+time.time()-start+geometry/len(laid_out))
+		results.append((pthread.apt,pthread.version,error,None))
+	return results
+	
+	
+# parse_records for several parking layouts: the records are read and the taxiway ends
+# computed once, then for every (park_spacing,park_distance) of variants the parkings
+# are computed and the networks written below the directory of that variant.
+# Returns (icao,version,variant,error) for every airport and variant.
+def sweep_records(records,tree,variants,stats,routes=False,writer=None):
+	results=[]
+	parsers=read_records(records,tree,None,None,stats,results,routes)
+	results=[(a,v,variant,error) for a,v,error,text in results for variant in variants]
+	start=time.time()
+	compute_ends(parsers)
+	ends=time.time()-start
+	stats.add_time('geometry',ends)
+	for variant in variants:
+		park_spacing,park_distance=variant
+		start=time.time()
+		compute_parking(parsers,park_spacing,park_distance)
+		for pthread in parsers:
+			pthread.park_spacing=park_spacing
+			pthread.park_distance=park_distance
+		geometry=time.time()-start
+		stats.add_time('geometry',geometry)
+		done=generate_networks(parsers,ends+geometry,stats,writer=writer,root=sweep_root(variant))
+		results.extend([(a,v,variant,error) for a,v,error,text in done])
+	return results
+	
+	
+# Shard of an airport out of n, stable across machines and Python versions
+def shard_of(icao,n):
+	return int(hashlib.md5(icao).hexdigest()[:8],16) % n
+	
+	
+# Directory of the output trees and manifest of shard k out of n, below the working directory
+def shard_root(k,n):
+	return os.path.join(os.getcwd(),'shards','%d-of-%d' % (k,n))
+	
+	
+def shard_option(text):
+	k,n=[int(x) for x in text.split('/')]
+	if n<1 or k<0 or k>=n:
+		raise ValueError('shard %s is not K/N with 0 <= K < N' % text)
+	return k,n
+	
+	
+# Directory of the files of a sweep variant, below the working directory
+def sweep_root(variant):
+	return os.path.join(os.getcwd(),'sweep','spacing%g_distance%g' % variant)
+	
+	
+# Last stage of stream_all: writes the xml sent back by the workers and records the
+# airports in the manifest, queue_size batches may wait for it
+class NetworkWriter(threading.Thread):
+	def __init__(self,gn,queue_size):
+		threading.Thread.__init__(self)
+		self.gn=gn
+		self.results=Queue.Queue(queue_size)
+		self.hashes={}   # (icao,version) -> record sha1 of the airports in flight
+		self.params=gn.build_params()
+		self.output=OutputWriter()
+		self.processed=0
+		self.failed=0
 		
-		fr=open(os.path.join(os.getcwd(),airport_list))
-		content=fr.readlines()
-		for line in content:
-			self.missing_network.append(line.rstrip('\n'))
-		fr.close()
+	
+	def run(self):
+		gn=self.gn
+		while True:
+			results=self.results.get()
+			if results==None:
+				break
+			start=time.time()
+			writes=[]
+			for a,v,error,text in results:
+				path=None
+				if error==None:
+					path=network_path(a,v,gn.save_tree,root=gn.output_root)
+				if path!=None:
+					writes.append(self.output.submit(path,text))
+				else:
+					writes.append(None)
+			for (a,v,error,text),w in zip(results,writes):
+				if error==None and w==None:
+					error=error_text(ValueError(tree_error(a)))
+				record_hash=self.hashes.pop((a,v),None)
+				if w!=None:
+					try:
+						if w.get()==False:
+							gn.stats.count('unchanged')
+					except (IOError,OSError), e:
+						error=write_error(e)
+				if error!=None:
+					self.failed+=1
+					gn.stats.failures.append((a,error))
+					if not error.startswith(WRITE_ERROR):
+						gn.manifest.quarantine(v,a,record_hash,self.params,error)
+					print "error:",a,error
+				else:
+					if self.processed==0:
+						gn.stats.add_time('first_file',time.time()-gn.stats.started)
+					self.processed+=1
+					gn.manifest.update(v,a,record_hash,self.params)
+					print a
+			gn.stats.add_time('write',time.time()-start)
+		self.output.close()
 		
 	
-	def parse_all(self):
-		print "Airports to be processed:",len(self.apts)
-		print "Airports with missing network:",len(self.missing_network), "Airports with known format:",len(self.default_airports)
-		hh=0
+	def put(self,results):
+		# blocks while the queue is full, a timeout keeps the wait interruptible
+		while True:
+			try:
+				self.results.put(results,True,1)
+				return
+			except Queue.Full:
+				if self.is_alive()==False:
+					raise RuntimeError("writer thread stopped")
+	
+	
+def render_records(records):
+	tree,park_spacing,park_distance=worker['args']
+	stats=Stats()
+	return parse_records(records,tree,park_spacing,park_distance,stats,True,quarantine=False),stats.dump()
+	
+	
+# State of the serve mode: the indexes stay loaded, generated xml is kept in a LRU
+# cache and airports are generated by a worker pool. The workers get the record
+# lines, so they never map a data file which may be replaced.
+class GroundnetService:
+	def __init__(self,gn,cache_size):
+		self.gn=gn
+		self.cache_size=cache_size
+		self.cache=collections.OrderedDict()   # (version,icao) -> xml, oldest first
+		self.lock=threading.Lock()
+		self.indexes={}
+		self.hits=0
+		self.misses=0
+		for v in gn.versions:
+			self.indexes[v]=AptIndex(gn.data_path(v),v).load()
+		workers=gn.workers or multiprocessing.cpu_count()
+		self.pool=multiprocessing.Pool(workers,init_worker,({},gn.save_tree,gn.park_spacing,gn.park_distance))
 		
-		q=multiprocessing.Queue(10)
-		for a in self.apts:
-			hh+=1
-			print a, len(self.apts) - hh,"left"
-			#self.parse_airport( a)
-			index=dict(self.apt_index)
-			content=self.apt_content[index[a]-1:index[a]+40]
-			q.put(hh)	
-			pthread=Parser(a,self.save_tree,self.park_spacing,self.park_distance,content,self.version,q,hh)
-			pthread.start()
-			
-			
-	def parse_airport(self,a):
-		q=multiprocessing.Queue(2)
-		hh=1
-		print apt
-		q.put(hh)
-		pthread=Parser(a,self.save_tree,self.park_spacing,self.park_distance,self.apt_content,self.version,q,hh)
-		pthread.start()
-
-
-	def load_apt(self):
-		fr=open(os.path.join(os.getcwd(),'apt.dat'),'rb')
-		content=fr.readlines()
-		self.apt_content=content
-		fr.close()
-		i=0
-		for line in content:
-			if re.search("^1\s+",line)!=None:
-				num_segs=0
-				seg_len=[]
-				for k in range(i+1,i+10):
-					if content[k]=='\n' or content[k]=='\r\n':
-						break
-					if re.search("^10\s+.*?xxx\s+",content[k])!=None:
-						data=content[k].split()
-						seg_len.append(data[5])
-						num_segs +=1
-				if num_segs==4:
-					if seg_len[0]==seg_len[1] and seg_len[0]==seg_len[2] and float(seg_len[0])<float(seg_len[3]) and float(seg_len[3])>=2000:
-						match=re.search("^1\s+[0-9]+\s+[0-9]+\s+[0-9]+\s+([0-9A-Z]{3,5})\s+",line)
-						if match!=None:
-							if match.group(1) not in self.default_airports:
-								self.default_airports.append(match.group(1))
-								self.apt_index.append((match.group(1),i))
-			i+=1
-			
 	
-	def load_apt_850(self):
-		fr=open(os.path.join(os.getcwd(),'apt850.dat'),'rb')
-		content=fr.readlines()
-		self.apt_content=content
-		fr.close()
-		i=0
-		for line in content:
-			if re.search("^1\s+",line)!=None:
-				num_segs=0
-				num_taxiways=0
-				num_bezier=0
-				num_holds=0
-				seg_len=[]
-				for k in range(i+1,i+40):
-					if content[k]=='\n' or content[k]=='\r\n':
-						break
-					if re.search("^110\s+",content[k])!=None:
-						num_taxiways +=1
-					if re.search("^112\s+",content[k])!=None:
-						num_bezier +=1
-					if re.search("^120\s+",content[k])!=None:
-						num_holds +=1
-					if re.search("^111\s+",content[k])!=None:
-						data=content[k].split()
-						#seg_len.append(data[5])
-						num_segs +=1
-				if num_segs==14 and num_taxiways==1 and num_bezier==4 and num_holds==3:
-					#if seg_len[0]==seg_len[1] and seg_len[0]==seg_len[2] and float(seg_len[0])<float(seg_len[3]) and float(seg_len[3])>=2000:
-					match=re.search("^1\s+[0-9]+\s+[0-9]+\s+[0-9]+\s+([0-9A-Z]{3,5})\s+",line)
-					if match!=None:
-						if match.group(1) not in self.default_airports:
-							self.default_airports.append(match.group(1))
-							self.apt_index.append((match.group(1),i))
-			i+=1
+	def current_index(self,version):
+		# called with the lock held, reloads the index of a version when its data
+		# file changed and drops the cached xml when the content is different
+		index=self.indexes[version]
+		st=os.stat(index.path)
+		if st.st_size!=index.source['size'] or st.st_mtime!=index.source['mtime']:
+			sha=index.source['sha1']
+			index=AptIndex(index.path,version).load()
+			self.indexes[version]=index
+			if index.source['sha1']!=sha:
+				for key in self.cache.keys():
+					if key[0]==version:
+						del self.cache[key]
+		return index
 		
+	
+	# Returns the http status and the xml or the error text
+	def generate(self,version,icao):
+		key=(version,icao)
+		with self.lock:
+			index=self.current_index(version)
+			if key in self.cache:
+				self.hits+=1
+				text=self.cache.pop(key)
+				self.cache[key]=text
+				return 200,text
+			self.misses+=1
+			if icao not in index.airports:
+				return 404,"Airport %s not found in %s\n" % (icao,os.path.basename(index.path))
+			if index.airports[icao][3] & format_flag(version)==0:
+				return 404,"Airport %s does not fit the default %d layout\n" % (icao,version)
+			content=index.read_record(icao)
+		results,stats=self.pool.apply(render_records,([(icao,version,content)],))
+		self.gn.stats.merge(stats)
+		a,v,error,text=results[0]
+		if error!=None:
+			self.gn.stats.failures.append((icao,error))
+			return 500,"%s: %s\n" % (icao,error)
+		with self.lock:
+			# a result from a data file replaced in the meantime is not cached
+			if self.indexes[version] is index:
+				self.cache[key]=text
+				while len(self.cache)>self.cache_size:
+					self.cache.popitem(False)
+		return 200,text
 		
-	def check_already_done(self):
-		if self.version==850:
-			output_dir='output850'
-		else:
-			output_dir='output'
-		if self.save_tree==False:
-			done_files1=glob.glob(os.path.join(os.getcwd(),output_dir,'*.xml'))
+	
+	def status(self):
+		with self.lock:
+			return {'cached':len(self.cache),'hits':self.hits,'misses':self.misses,
+				'failed':len(self.gn.stats.failures),
+				'sources':dict([(str(v),self.indexes[v].source) for v in self.indexes])}
+		
+	
+	def close(self):
+		self.pool.terminate()
+		self.pool.join()
+		
+		
+# GET /<ICAO> or /<version>/<ICAO> returns the groundnet xml, GET /status some counters
+class ServiceHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+	def do_GET(self):
+		service=self.server.service
+		parts=[p for p in self.path.split('?')[0].split('/') if p!='']
+		if parts==['status']:
+			self.reply(200,json.dumps(service.status(),sort_keys=True)+'\n','application/json')
+			return
+		version=service.gn.version
+		if len(parts)==2 and parts[0] in ('810','850'):
+			version=int(parts[0])
+			parts=parts[1:]
+		if len(parts)!=1 or version not in service.indexes:
+			self.reply(404,"Usage: /<ICAO>, /810/<ICAO>, /850/<ICAO> or /status\n")
+			return
+		code,text=service.generate(version,parts[0].upper())
+		if code==200:
+			self.reply(code,text,'application/xml')
 		else:
-			done_files1=glob.glob(os.path.join(os.getcwd(),output_dir,'Airports','*','*','*','*.xml'))
-			
-		for d in done_files1:
-			icao1=d.split('.')
-			icao=icao1[0].split('/')
-			if icao[-1] not in self.done_files:
-				self.done_files.append(icao[-1])
-			
+			self.reply(code,text)
 		
+	
+	def reply(self,code,text,content_type='text/plain'):
+		self.send_response(code)
+		self.send_header('Content-Type',content_type)
+		self.send_header('Content-Length',str(len(text)))
+		self.end_headers()
+		self.wfile.write(text)
+		
+	
+	def log_message(self,format,*args):
+		# unix socket clients have no address
+		client='local'
+		if isinstance(self.client_address,tuple):
+			client=self.client_address[0]
+		sys.stderr.write("%s - - [%s] %s\n" % (client,self.log_date_time_string(),format % args))
+		
+		
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn,BaseHTTPServer.HTTPServer):
+	daemon_threads=True
+	
+	
+class ThreadingUnixServer(SocketServer.ThreadingMixIn,SocketServer.UnixStreamServer):
+	daemon_threads=True
+	
+	
+# Path of a generated file in the output directories below root, the working directory by
+# default. None when the ICAO code has no place in the Airports tree, see tree_error.
+def network_path(apt,version,save_tree,suffix='.groundnet.xml',root=None):
+	dir_path=''
+	output_dir='output'
+	if version==850:
+		output_dir='output850'
+	if root==None:
+		root=os.getcwd()
+	if save_tree==True:
+		if len(apt)==4 or len(apt)==3:
+			dir_path=os.path.join(root,output_dir,'Airports',apt[0],apt[1],apt[2])
+		else:
+			return None
+	else:
+		dir_path=os.path.join(root,output_dir)
+	return os.path.join(dir_path,apt+suffix)
+	
+	
+# Writes text to path through a temporary file renamed over it, so that an interrupted
+# run never leaves a truncated file. A file which already holds text is not touched
+# and keeps its mtime. dirs caches the directories known to exist.
+# Returns True if the file was written, False if it was unchanged.
+def write_file(path,text,dirs=None):
+	dir_path=os.path.dirname(path)
+	if dirs==None or dir_path not in dirs:
+		if os.path.isdir(dir_path)==False:
+			try:
+				os.makedirs(dir_path,0755)
+			except OSError:
+				# made by another worker meanwhile
+				if os.path.isdir(dir_path)==False:
+					raise
+		if dirs!=None:
+			dirs.add(dir_path)
+	try:
+		if os.path.getsize(path)==len(text):
+			fr=open(path,'rb')
+			try:
+				if fr.read()==text:
+					return False
+			finally:
+				fr.close()
+	except (IOError,OSError):
+		pass
+	tmp_path='%s.%d.tmp' % (path,os.getpid())
+	fw=open(tmp_path,'wb')
+	try:
+		fw.write(text)
+		fw.close()
+		os.rename(tmp_path,path)
+	except:
+		fw.close()
+		os.remove(tmp_path)
+		raise
+	return True
+	
+	
+# Pool of threads writing the generated files with write_file, so that the computation
+# of the next airports goes on during the disk I/O of the previous ones
+class OutputWriter:
+	def __init__(self,threads=WRITER_THREADS):
+		self.pool=multiprocessing.pool.ThreadPool(threads)
+		self.dirs=set()   # output directories made or seen by this writer
 		
-	def check_groundnet(self,arg,dirname,filenames):
-		if dirname.find(".svn")!=-1:
-			return
-		found_files=False
-		icao_list=[]
-		for filename in filenames:
-			if re.search(".xml",filename)!=None:
-				found_files=True
-				tokens=filename.split(".")
-				if os.path.exists(os.path.join(dirname,tokens[0]+".groundnet.xml")):
-					continue
-				if os.path.exists(os.path.join(dirname,tokens[0]+".parking.xml")):
-					continue
-				else:
-					if tokens[0] not in self.missing_network:
-						self.missing_network.append(tokens[0])
 	
+	def submit(self,path,text):
+		# the result of the returned AsyncResult is that of write_file
+		return self.pool.apply_async(write_file,(path,text,self.dirs))
 		
-class Parser(multiprocessing.Process):
 	
-	def __init__(self,apt,tree,park_spacing,park_distance,content,version,q,hh):
-		multiprocessing.Process.__init__(self)
+	def close(self):
+		self.pool.close()
+		self.pool.join()
+	
+	
+# Networks failing validation are written flat to quarantine/output or quarantine/output850
+def quarantine_path(apt,version,root=None):
+	output_dir='output'
+	if version==850:
+		output_dir='output850'
+	return os.path.join(root or os.getcwd(),'quarantine',output_dir,apt+'.groundnet.xml')
+	
+	
+def error_text(e):
+	return '%s: %s' % (e.__class__.__name__,e)
+	
+	
+def write_error(e):
+	return '%s: %s' % (WRITE_ERROR,error_text(e))
+	
+	
+def tree_error(apt):
+	return 'ICAO code of %d letters does not fit the Airports tree' % len(apt)
+	
+	
+class Parser:
+	
+	def __init__(self,apt,tree,park_spacing,park_distance,content,version,routes=False):
 		self.apt=apt
+		self.routes=routes   # also write the parking to hold point routes
 		self.save_tree=tree
 		self.park_spacing=park_spacing
 		self.apt_content=content
-		self.q=q
-		self.ids=hh
 		self.park_distance=park_distance
 		self.version=version
+		self.warnings=[]
+		self.graph=None   # TaxiGraph of the network, set by layout
 		
 	
-	def run(self):
+	def read(self):
+		if self.version == 850:
+			self.read_airport_850()
+		else:
+			self.read_airport()
+			
+	
+	def layout(self):
+		if self.version == 850:
+			self.layout_airport_850()
+		else:
+			self.layout_airport()
+			
+	
+	def serialize(self):
+		out=cStringIO.StringIO()
 		if self.version == 850:
-			self.parse_airport_850(self.apt)
+			self.write_airport_850(out)
 		else:
-			self.parse_airport(self.apt)
-		self.q.get(self.ids)
+			self.write_airport(out)
+		return out.getvalue()
 		
-	########## 810 #############	
-	def parse_airport(self,apt):
-		xml=[]
-		xml.append('<?xml version="1.0"?>\n<groundnet>\n<version>1</version>\n<frequencies>\n')
-		content=self.apt_content
-		i=0
-		line_data=[]
-		freq_data=[]
-		
-		for line in content:
-			if re.search("^1\s+[0-9]{1,7}\s+[0-9]{1}\s+[0-9]{1}\s+"+apt+"\s+",line)!=None:
-				for k in range(i+1,i+15):
-					if content[k]=='\n' or content[k]=='\r\n':
-						break
-					if re.search("^10\s+.*?xxx\s+",content[k])!=None:
-						line_data.append(content[k])
-				for z in range(i+4,i+25):
-					if content[z]=='\n':
-						break
-					if re.search("^5[0-9]{1}\s+([0-9]{5})\s+",content[z])!=None:
-						freq_data.append(content[z])
-			i+=1
+	
+	def build(self,root=None):
+		for path,text in self.outputs(root):
+			write_file(path,text)
 			
+	
+	def outputs(self,root=None):
+		# (path,text) of the files of this airport
+		path=network_path(self.apt,self.version,self.save_tree,root=root)
+		if path==None:
+			raise ValueError(tree_error(self.apt))
+		files=[(path,self.serialize())]
+		if self.routes:
+			out=cStringIO.StringIO()
+			self.write_routes(out)
+			files.append((network_path(self.apt,self.version,self.save_tree,'.routes.json',root),out.getvalue()))
+		return files
 		
-		for ln in freq_data:
-			freq=ln.split()
-			if freq[0]=='50':
-				xml.append('\t<AWOS>'+freq[1]+'</AWOS>\n')
-			if freq[0]=='51':
-				xml.append('\t<UNICOM>'+freq[1]+'</UNICOM>\n')
-			if freq[0]=='52':
-				xml.append('\t<CLEARANCE>'+freq[1]+'</CLEARANCE>\n')
-			if freq[0]=='53':
-				xml.append('\t<GROUND>'+freq[1]+'</GROUND>\n')
-			if freq[0]=='54':
-				xml.append('\t<TOWER>'+freq[1]+'</TOWER>\n')
-			if freq[0]=='55':
-				xml.append('\t<APPROACH>'+freq[1]+'</APPROACH>\n')
-			if freq[0]=='56':
-				xml.append('\t<APPROACH>'+freq[1]+'</APPROACH>\n')
-				
-		xml.append('</frequencies>\n')
+	
+	def write_routes(self,out):
+		# shortest taxi routes from every parking to every hold point of self.graph
+		routes=self.graph.routes()
+		reached=set([r[0] for r in routes])
+		for i in self.graph.nodes(NODE_PARKING):
+			if self.graph.index[i] not in reached:
+				self.warn('parking %d reaches no hold point' % self.graph.index[i])
+		data={'airport':self.apt,'routes':[{'parking':p,'hold':h,'length':round(length,1),'nodes':path} for p,h,length,path in routes]}
+		json.dump(data,out,sort_keys=True)
+		out.write('\n')
+		
+	########## 810 #############	
+	def read_airport(self):
+		self.runways=[]
+		self.taxiways=[]
+		self.park_origins=[]
+		self.read_rows(self.ROWS_810,25)
+		
+	
+	def read_runway_810(self,num,tokens,line):
+		if num>=15:
+			return
+		row=parse_runway_810(tokens)
+		if is_taxiway_810(tokens):
+			self.taxiways.append(row)
+			if row.length/2 > 300:
+				self.park_origins.append(row)
+		else:
+			self.runways.append(row)
+			
+	
+	def layout_airport(self):
 		nodes=[]
 		subnodes=[]
 		park=[]
-		tt=0
+		self.parking_lists=[]
 		index=8
+		qq=0
 		
-		for line in line_data:
-			tt+=1
-			METER_TO_NM=0.0005399568034557235
-			NM_TO_RAD=0.00029088820866572159
-			FEET_TO_METER=0.3048
-			tokens = line.split()
-			lat = float(tokens[1])
-			lon = float(tokens[2])
-			heading = float(tokens[4])
-			heading_back=heading+180.0
-			if heading_back>=360.0:
-				heading_back=heading_back-360.0
-			length = float(tokens[5]) * FEET_TO_METER / 2
-			width = float(tokens[7])
-			# lat=asin(sin(lat1)*cos(d)+cos(lat1)*sin(d)*cos(tc))
-			#lon=mod(lon1-asin(sin(tc)*sin(d)/cos(lat))+pi,2*pi)-pi
-			
-			length_rad= length * METER_TO_NM * NM_TO_RAD
-			
-			lat1=math.degrees(math.asin(math.sin(math.radians(lat))*math.cos(length_rad)+math.cos(math.radians(lat))*math.sin(length_rad)*math.cos(math.radians(heading))))
-			lon1=math.degrees(math.fmod(math.radians(lon)-math.asin(math.sin(math.radians(heading))*math.sin(length_rad)/math.cos(math.radians(lat1))) + math.pi,2*math.pi)-math.pi)
-			
-			lat_end=math.degrees(math.asin(math.sin(math.radians(lat))*math.cos(length_rad)+math.cos(math.radians(lat))*math.sin(length_rad)*math.cos(math.radians(heading_back))))
-			lon_end=math.degrees(math.fmod(math.radians(lon)-math.asin(math.sin(math.radians(heading_back))*math.sin(length_rad)/math.cos(math.radians(lat_end))) + math.pi,2*math.pi)-math.pi)
+		for tt in range(len(self.taxiways)):
+			row=self.taxiways[tt]
+			lat1,lon_end,lat_end,lon1=self.ends[tt]
 			
 			index+=1
-			nodes.append((lat1,lon_end,index))
+			nodes.append((index,lat1,lon_end))
 			index+=1
-			nodes.append((lat,lon,index))
+			nodes.append((index,row.lat,row.lon))
 			index+=1
-			nodes.append((lat_end,lon1,index))
-			#print lat,lat1,lat_end,lon,lon1,lon_end
+			nodes.append((index,lat_end,lon1))
 			
-			if length > 300:
-				xml.append('<parkingList>')
+			if row.length/2 > 300:
+				parkings=[]
 				yy=0
-				for i in range(1,10):
-					length_rad= self.park_spacing * i * METER_TO_NM * NM_TO_RAD
-					lat2=math.degrees(math.asin(math.sin(math.radians(lat))*math.cos(length_rad)+math.cos(math.radians(lat))*math.sin(length_rad)*math.cos(math.radians(heading))))
-					lon2=math.degrees(math.fmod(math.radians(lon)-math.asin(math.sin(math.radians(heading))*math.sin(length_rad)/math.cos(math.radians(lat2))) + math.pi,2*math.pi)-math.pi)
-					lat2_end=math.degrees(math.asin(math.sin(math.radians(lat))*math.cos(length_rad)+math.cos(math.radians(lat))*math.sin(length_rad)*math.cos(math.radians(heading_back))))
-					lon2_end=math.degrees(math.fmod(math.radians(lon)-math.asin(math.sin(math.radians(heading_back))*math.sin(length_rad)/math.cos(math.radians(lat2_end))) + math.pi,2*math.pi)-math.pi)
-					length_rad2=self.park_distance * METER_TO_NM * NM_TO_RAD
-					heading2=heading+90
-					
-					if(heading2>=360):
-						heading2=heading2-360
-						
-					heading2_back=heading2 +180
-					if heading2_back >=360:
-						heading2_back=heading2_back-360
-						
-					lat3=math.degrees(math.asin(math.sin(math.radians(lat2))*math.cos(length_rad2)+math.cos(math.radians(lat2))*math.sin(length_rad2)*math.cos(math.radians(heading2))))
-					lon3=math.degrees(math.fmod(math.radians(lon2_end)-math.asin(math.sin(math.radians(heading2))*math.sin(length_rad2)/math.cos(math.radians(lat3))) + math.pi,2*math.pi)-math.pi)
-					
-					lat3_end=math.degrees(math.asin(math.sin(math.radians(lat2))*math.cos(length_rad2)+math.cos(math.radians(lat2))*math.sin(length_rad2)*math.cos(math.radians(heading2_back))))
-					lon3_end=math.degrees(math.fmod(math.radians(lon2_end)-math.asin(math.sin(math.radians(heading2_back))*math.sin(length_rad2)/math.cos(math.radians(lat3_end))) + math.pi,2*math.pi)-math.pi)
-					
-					xml.append(self.gen_parking(lat3,lon3_end,yy,heading2_back))
-					park.append((lat3,lon3,yy))
+				positions,heading2_back=self.parking[qq]
+				qq+=1
+				for lat2,lon2_end,lat3,lon3_end in positions:
+					parkings.append((yy,lat3,lon3_end,heading2_back))
+					park.append((yy,lat3,lon3_end))
 					index+=1
-					subnodes.append((lat2,lon2_end,index))
+					subnodes.append((index,lat2,lon2_end))
 					yy+=1
-					
-					
-				xml.append('\n</parkingList>\n')
-			
-			
-		xml.append('<TaxiNodes>\n')
-		#print len(nodes)
-		#print len(subnodes)
-		#print len(park)
-		for n in nodes:
-			coord=self.convert_coord(n[0],n[1])
-			onrunway='0'
-			hold='none'
-			if n[2]==11 or n[2]==14 or n[2]==17:
-				onrunway='1'
-			if n[2]==10 or n[2]==13 or n[2]==16:
-				hold='normal'
-				
-			xml.append('\t<node index="'+str(n[2])+'" lat="'+coord[0]+'" lon="'+coord[1]+'" isOnRunway="'+onrunway+'" holdPointType="'+hold+'" />\n')
+				self.parking_lists.append(parkings)
 			
-			
-		for n in subnodes:
-			coord=self.convert_coord(n[0],n[1])
-			xml.append('\t<node index="'+str(n[2])+'" lat="'+coord[0]+'" lon="'+coord[1]+'" isOnRunway="0" holdPointType="none" />\n')
-			
-		
-		xml.append('</TaxiNodes>\n<TaxiWaySegments>\n')
-		
-		qq=0
-		for p in park:
-			xml.append('\t<arc begin="'+str(p[2])+'" end="'+str(subnodes[qq][2])+'" isPushBackRoute="0" name="" />\n')
-			xml.append('\t<arc begin="'+str(subnodes[qq][2])+'" end="'+str(p[2])+'" isPushBackRoute="0" name="" />\n')
-			qq+=1
-		
-		xml.append('\t<arc begin="'+str(nodes[0][2])+'" end="'+str(nodes[1][2])+'" isPushBackRoute="0" name="" />\n')
-		xml.append('\t<arc begin="'+str(nodes[1][2])+'" end="'+str(nodes[0][2])+'" isPushBackRoute="0" name="" />\n')
-		
-		xml.append('\t<arc begin="'+str(nodes[1][2])+'" end="'+str(nodes[2][2])+'" isPushBackRoute="0" name="" />\n')
-		xml.append('\t<arc begin="'+str(nodes[2][2])+'" end="'+str(nodes[1][2])+'" isPushBackRoute="0" name="" />\n')
-		
-		xml.append('\t<arc begin="'+str(nodes[0][2])+'" end="'+str(nodes[11][2])+'" isPushBackRoute="0" name="" />\n')
-		xml.append('\t<arc begin="'+str(nodes[11][2])+'" end="'+str(nodes[0][2])+'" isPushBackRoute="0" name="" />\n')
-		
-		xml.append('\t<arc begin="'+str(nodes[11][2])+'" end="'+str(nodes[10][2])+'" isPushBackRoute="0" name="" />\n')
-		xml.append('\t<arc begin="'+str(nodes[10][2])+'" end="'+str(nodes[11][2])+'" isPushBackRoute="0" name="" />\n')
-		
-		xml.append('\t<arc begin="'+str(nodes[10][2])+'" end="'+str(subnodes[0][2])+'" isPushBackRoute="0" name="" />\n')
-		xml.append('\t<arc begin="'+str(subnodes[0][2])+'" end="'+str(nodes[10][2])+'" isPushBackRoute="0" name="" />\n')
-		
-		pp=0
-		for s  in subnodes:
-			if pp > len(subnodes)-2:
-				break
-			xml.append('\t<arc begin="'+str(s[2])+'" end="'+str(subnodes[pp+1][2])+'" isPushBackRoute="0" name="" />\n')
-			xml.append('\t<arc begin="'+str(subnodes[pp+1][2])+'" end="'+str(s[2])+'" isPushBackRoute="0" name="" />\n')
-			pp+=1
-		
-		
-		
-		xml.append('\t<arc begin="'+str(nodes[9][2])+'" end="'+str(subnodes[-1][2])+'" isPushBackRoute="0" name="" />\n')
-		xml.append('\t<arc begin="'+str(subnodes[-1][2])+'" end="'+str(nodes[9][2])+'" isPushBackRoute="0" name="" />\n')
-		
-		xml.append('\t<arc begin="'+str(nodes[10][2])+'" end="'+str(nodes[3][2])+'" isPushBackRoute="0" name="" />\n')
-		xml.append('\t<arc begin="'+str(nodes[3][2])+'" end="'+str(nodes[10][2])+'" isPushBackRoute="0" name="" />\n')
+		graph=TaxiGraph()
+		nodes=[graph.add_node(i,lat,lon,node_flags(i,RUNWAY_NODES_810,HOLD_NODES_810)) for i,lat,lon in nodes]
+		subnodes=[graph.add_node(i,lat,lon) for i,lat,lon in subnodes]
+		park=[graph.add_node(i,lat,lon,NODE_PARKING) for i,lat,lon in park]
+		for qq in range(len(park)):
+			graph.add_arc(park[qq],subnodes[qq])
+		graph.add_arc(nodes[0],nodes[1])
+		graph.add_arc(nodes[1],nodes[2])
+		graph.add_arc(nodes[0],nodes[11])
+		graph.add_arc(nodes[11],nodes[10])
+		graph.add_arc(nodes[10],subnodes[0])
+		for pp in range(len(subnodes)-1):
+			graph.add_arc(subnodes[pp],subnodes[pp+1])
+		graph.add_arc(nodes[9],subnodes[-1])
+		graph.add_arc(nodes[10],nodes[3])
+		graph.add_arc(nodes[3],nodes[4])
+		graph.add_arc(nodes[4],nodes[5])
+		graph.add_arc(nodes[6],nodes[9])
+		graph.add_arc(nodes[6],nodes[7])
+		graph.add_arc(nodes[7],nodes[8])
+		self.graph=graph
 		
-		xml.append('\t<arc begin="'+str(nodes[3][2])+'" end="'+str(nodes[4][2])+'" isPushBackRoute="0" name="" />\n')
-		xml.append('\t<arc begin="'+str(nodes[4][2])+'" end="'+str(nodes[3][2])+'" isPushBackRoute="0" name="" />\n')
-		
-		xml.append('\t<arc begin="'+str(nodes[4][2])+'" end="'+str(nodes[5][2])+'" isPushBackRoute="0" name="" />\n')
-		xml.append('\t<arc begin="'+str(nodes[5][2])+'" end="'+str(nodes[4][2])+'" isPushBackRoute="0" name="" />\n')
-		
-		xml.append('\t<arc begin="'+str(nodes[6][2])+'" end="'+str(nodes[9][2])+'" isPushBackRoute="0" name="" />\n')
-		xml.append('\t<arc begin="'+str(nodes[9][2])+'" end="'+str(nodes[6][2])+'" isPushBackRoute="0" name="" />\n')
+	
+	def write_airport(self,out):
+		if self.graph==None:
+			self.layout_airport()
+		self.write_network(out)
 		
-		xml.append('\t<arc begin="'+str(nodes[6][2])+'" end="'+str(nodes[7][2])+'" isPushBackRoute="0" name="" />\n')
-		xml.append('\t<arc begin="'+str(nodes[7][2])+'" end="'+str(nodes[6][2])+'" isPushBackRoute="0" name="" />\n')
+	
+	# xml of the network laid out by layout_airport or layout_airport_850
+	def write_network(self,out):
+		write=out.write
+		write(XML_HEADER)
+		self.write_frequencies(out)
+		for parkings in self.parking_lists:
+			write('<parkingList>')
+			for yy,lat,lon,heading in parkings:
+				write(PARKING_TEMPLATE % ((yy,yy+1)+format_coord(lat,lon)+(heading,)))
+			write('\n</parkingList>\n')
+		write('<TaxiNodes>\n')
+		self.graph.write_nodes(out)
+		write('</TaxiNodes>\n<TaxiWaySegments>\n')
+		self.graph.write_arcs(out)
+		write('</TaxiWaySegments>\n</groundnet>\n')
 		
-		xml.append('\t<arc begin="'+str(nodes[7][2])+'" end="'+str(nodes[8][2])+'" isPushBackRoute="0" name="" />\n')
-		xml.append('\t<arc begin="'+str(nodes[8][2])+'" end="'+str(nodes[7][2])+'" isPushBackRoute="0" name="" />\n')
+	################ 850 #################
+	def read_airport_850(self):
+		self.runways=[]
+		self.pavement=[]
+		self.heading=0
+		self.read_rows(self.ROWS_850,40)
+		heading=self.heading
 		
+		nodes=[n for n in self.pavement if n.code in LAYOUT_NODE_CODES]
+		center1=self.find_midpoint(nodes[8].lat,nodes[11].lat,nodes[8].lon,nodes[11].lon,0)
+		center2=self.find_midpoint(nodes[1].lat,nodes[2].lat,nodes[1].lon,nodes[2].lon,0)
 		
 		
-		xml.append('</TaxiWaySegments>\n</groundnet>\n')
+		newnodes=[]
+		newnodes.append(self.find_midpoint(nodes[0].lat,nodes[15].lat,nodes[0].lon,nodes[15].lon,9))
+		newnodes.append(self.find_midpoint(nodes[16].lat,nodes[17].lat,nodes[16].lon,nodes[17].lon,10))
+		newnodes.append(self.find_midpoint(nodes[1].lat,nodes[12].lat,nodes[1].lon,nodes[12].lon,11))
+		newnodes.append(self.find_midpoint(center1.lat,center2.lat,center1.lon,center2.lon,12))
+		newnodes.append(self.find_midpoint(nodes[2].lat,nodes[7].lat,nodes[2].lon,nodes[7].lon,13))
+		newnodes.append(self.find_midpoint(nodes[20].lat,nodes[21].lat,nodes[20].lon,nodes[21].lon,14))
+		newnodes.append(self.find_midpoint(nodes[3].lat,nodes[4].lat,nodes[3].lon,nodes[4].lon,15))
+		newnodes.append(self.find_midpoint(nodes[18].lat,nodes[19].lat,nodes[18].lon,nodes[19].lon,16))
+		newnodes.append(self.find_midpoint(nodes[9].lat,nodes[10].lat,nodes[9].lon,nodes[10].lon,17))
+		
+		self.newnodes=newnodes
+		self.taxiways=[]
+		# the long taxiway passes through the center node, along the pavement heading
+		self.park_origins=[RunwayRow(110,newnodes[2].lat,newnodes[2].lon,'xxx',heading,0.0,0.0)]
 		
-		self.save_network(apt,xml)
+	
+	def read_node_850(self,num,tokens,line):
+		if tokens[2]=='ASOS':
+			self.warn('ASOS row among the pavement nodes')
+		self.pavement.append(parse_pavement_node(tokens))
 		
-	################ 850 #################
-	def parse_airport_850(self,apt):
-		xml=[]
-		xml.append('<?xml version="1.0"?>\n<groundnet>\n<version>1</version>\n<frequencies>\n')
-		content=self.apt_content
-		i=0
-		line_data=[]
-		freq_data=[]
-		heading=0
-		
-		for line in content:
-			if re.search("^1\s+[0-9]{1,7}\s+[0-9]{1}\s+[0-9]{1}\s+"+apt+"\s+",line)!=None:
-				for k in range(i+1,i+40):
-					if content[k]=='\n' or content[k]=='\r\n':
-						break
-					if re.search("^111\s+",content[k])!=None:
-						line_data.append(content[k])
-					if re.search("^112\s+",content[k])!=None:
-						line_data.append(content[k])
-					if re.search("^113\s+",content[k])!=None:
-						line_data.append(content[k])
-					if re.search("^115\s+",content[k])!=None:
-						line_data.append(content[k])
-					if re.search("^110\s+[0-9.]+\s+[0-9.]+\s+([0-9.]+)\s+",content[k])!=None:
-						tok=content[k].split()
-						heading=float(tok[3])
-				for z in range(i+4,i+40):
-					if content[z]=='\n':
-						break
-					if re.search("^5[0-9]{1}\s+([0-9]{5})\s+",content[z])!=None:
-						freq_data.append(content[z])
-			i+=1
+	
+	def read_pavement_850(self,num,tokens,line):
+		if len(tokens)>3 and is_decimal(tokens[1]) and is_decimal(tokens[2]) and is_decimal(tokens[3]):
+			self.heading=float(tokens[3])
 			
+	
+	def read_runway_850(self,num,tokens,line):
+		self.runways.append(parse_runway_850(tokens))
 		
-		for ln in freq_data:
-			freq=ln.split()
-			if freq[0]=='50':
-				xml.append('\t<AWOS>'+freq[1]+'</AWOS>\n')
-			if freq[0]=='51':
-				xml.append('\t<UNICOM>'+freq[1]+'</UNICOM>\n')
-			if freq[0]=='52':
-				xml.append('\t<CLEARANCE>'+freq[1]+'</CLEARANCE>\n')
-			if freq[0]=='53':
-				xml.append('\t<GROUND>'+freq[1]+'</GROUND>\n')
-			if freq[0]=='54':
-				xml.append('\t<TOWER>'+freq[1]+'</TOWER>\n')
-			if freq[0]=='55':
-				xml.append('\t<APPROACH>'+freq[1]+'</APPROACH>\n')
-			if freq[0]=='56':
-				xml.append('\t<APPROACH>'+freq[1]+'</APPROACH>\n')
-				
-		xml.append('</frequencies>\n')
-		nodes=[]
+	
+	def layout_airport_850(self):
 		subnodes=[]
 		park=[]
-		tt=0
-		index=8
-		
-		for line in line_data:
-			tt+=1
-			METER_TO_NM=0.0005399568034557235
-			NM_TO_RAD=0.00029088820866572159
-			FEET_TO_METER=0.3048
-			tokens = line.split()
-			lat = float(tokens[1])
-			if tokens[2]=='ASOS':
-				print "error: ", apt
-			lon = float(tokens[2])
-			node_type = int(tokens[0])
-			
-			nodes.append((lat,lon,index))
-		
-		center1=self.find_midpoint(nodes[8][0],nodes[11][0],nodes[8][1],nodes[11][1],0)
-		center2=self.find_midpoint(nodes[1][0],nodes[2][0],nodes[1][1],nodes[2][1],0)
-		
-		
-		newnodes=[]
-		newnodes.append(self.find_midpoint(nodes[0][0],nodes[15][0],nodes[0][1],nodes[15][1],9))
-		newnodes.append(self.find_midpoint(nodes[16][0],nodes[17][0],nodes[16][1],nodes[17][1],10))
-		newnodes.append(self.find_midpoint(nodes[1][0],nodes[12][0],nodes[1][1],nodes[12][1],11))
-		newnodes.append(self.find_midpoint(center1[0],center2[0],center1[1],center2[1],12))
-		newnodes.append(self.find_midpoint(nodes[2][0],nodes[7][0],nodes[2][1],nodes[7][1],13))
-		newnodes.append(self.find_midpoint(nodes[20][0],nodes[21][0],nodes[20][1],nodes[21][1],14))
-		newnodes.append(self.find_midpoint(nodes[3][0],nodes[4][0],nodes[3][1],nodes[4][1],15))
-		newnodes.append(self.find_midpoint(nodes[18][0],nodes[19][0],nodes[18][1],nodes[19][1],16))
-		newnodes.append(self.find_midpoint(nodes[9][0],nodes[10][0],nodes[9][1],nodes[10][1],17))
-			
-		
-		heading_back=heading+180.0
-		if heading_back>=360.0:
-			heading_back=heading_back-360.0
-		lat=newnodes[2][0]
-		lon=newnodes[2][1]
+		parkings=[]
 		index=17
-		xml.append('<parkingList>')
 		yy=0
-		for i in range(1,10):
-			length_rad= self.park_spacing * i * METER_TO_NM * NM_TO_RAD
-			lat2=math.degrees(math.asin(math.sin(math.radians(lat))*math.cos(length_rad)+math.cos(math.radians(lat))*math.sin(length_rad)*math.cos(math.radians(heading))))
-			lon2=math.degrees(math.fmod(math.radians(lon)-math.asin(math.sin(math.radians(heading))*math.sin(length_rad)/math.cos(math.radians(lat2))) + math.pi,2*math.pi)-math.pi)
-			lat2_end=math.degrees(math.asin(math.sin(math.radians(lat))*math.cos(length_rad)+math.cos(math.radians(lat))*math.sin(length_rad)*math.cos(math.radians(heading_back))))
-			lon2_end=math.degrees(math.fmod(math.radians(lon)-math.asin(math.sin(math.radians(heading_back))*math.sin(length_rad)/math.cos(math.radians(lat2_end))) + math.pi,2*math.pi)-math.pi)
-			length_rad2=self.park_distance * METER_TO_NM * NM_TO_RAD
-			heading2=heading+90
-			
-			if(heading2>=360):
-				heading2=heading2-360
-				
-			heading2_back=heading2 +180
-			if heading2_back >=360:
-				heading2_back=heading2_back-360
-				
-			lat3=math.degrees(math.asin(math.sin(math.radians(lat2))*math.cos(length_rad2)+math.cos(math.radians(lat2))*math.sin(length_rad2)*math.cos(math.radians(heading2))))
-			lon3=math.degrees(math.fmod(math.radians(lon2_end)-math.asin(math.sin(math.radians(heading2))*math.sin(length_rad2)/math.cos(math.radians(lat3))) + math.pi,2*math.pi)-math.pi)
-			
-			lat3_end=math.degrees(math.asin(math.sin(math.radians(lat2))*math.cos(length_rad2)+math.cos(math.radians(lat2))*math.sin(length_rad2)*math.cos(math.radians(heading2_back))))
-			lon3_end=math.degrees(math.fmod(math.radians(lon2_end)-math.asin(math.sin(math.radians(heading2_back))*math.sin(length_rad2)/math.cos(math.radians(lat3_end))) + math.pi,2*math.pi)-math.pi)
-			
-			xml.append(self.gen_parking(lat3,lon3_end,yy,heading2_back))
-			park.append((lat3,lon3,yy))
+		positions,heading2_back=self.parking[0]
+		for lat2,lon2_end,lat3,lon3_end in positions:
+			parkings.append((yy,lat3,lon3_end,heading2_back))
+			park.append((yy,lat3,lon3_end))
 			index+=1
-			subnodes.append((lat2,lon2_end,index))
+			subnodes.append((index,lat2,lon2_end))
 			yy+=1
-			
-			
-		xml.append('\n</parkingList>\n')
-			
-			
-		xml.append('<TaxiNodes>\n')
-		#print len(nodes)
-		#print len(subnodes)
-		#print len(park)
-		
-		
-		
-		for n in newnodes:
-			coord=self.convert_coord(n[0],n[1])
-			onrunway='0'
-			hold='none'
-			if n[2]==9 or n[2]==15 or n[2]==17:
-				onrunway='1'
-			if n[2]==10 or n[2]==14 or n[2]==16:
-				hold='normal'
-				
-			xml.append('\t<node index="'+str(n[2])+'" lat="'+coord[0]+'" lon="'+coord[1]+'" isOnRunway="'+onrunway+'" holdPointType="'+hold+'" />\n')
-			
-			
-		for n in subnodes:
-			coord=self.convert_coord(n[0],n[1])
-			xml.append('\t<node index="'+str(n[2])+'" lat="'+coord[0]+'" lon="'+coord[1]+'" isOnRunway="0" holdPointType="none" />\n')
-			
-		
-		xml.append('</TaxiNodes>\n<TaxiWaySegments>\n')
-		
-		qq=0
-		for p in park:
-			xml.append('\t<arc begin="'+str(p[2])+'" end="'+str(subnodes[qq][2])+'" isPushBackRoute="0" name="" />\n')
-			xml.append('\t<arc begin="'+str(subnodes[qq][2])+'" end="'+str(p[2])+'" isPushBackRoute="0" name="" />\n')
-			qq+=1
-		
-		xml.append('\t<arc begin="'+str(newnodes[0][2])+'" end="'+str(newnodes[1][2])+'" isPushBackRoute="0" name="" />\n')
-		xml.append('\t<arc begin="'+str(newnodes[1][2])+'" end="'+str(newnodes[0][2])+'" isPushBackRoute="0" name="" />\n')
+		self.parking_lists=[parkings]
+		
+		graph=TaxiGraph()
+		newnodes=[graph.add_node(n.index,n.lat,n.lon,node_flags(n.index,RUNWAY_NODES_850,HOLD_NODES_850)) for n in self.newnodes]
+		subnodes=[graph.add_node(i,lat,lon) for i,lat,lon in subnodes]
+		park=[graph.add_node(i,lat,lon,NODE_PARKING) for i,lat,lon in park]
+		for qq in range(len(park)):
+			graph.add_arc(park[qq],subnodes[qq])
+		graph.add_arc(newnodes[0],newnodes[1])
+		graph.add_arc(newnodes[1],newnodes[2])
+		graph.add_arc(newnodes[2],subnodes[0])
+		for pp in range(len(subnodes)-1):
+			graph.add_arc(subnodes[pp],subnodes[pp+1])
+		graph.add_arc(newnodes[3],subnodes[-1])
+		graph.add_arc(newnodes[3],newnodes[4])
+		graph.add_arc(newnodes[4],newnodes[5])
+		graph.add_arc(newnodes[6],newnodes[5])
+		graph.add_arc(newnodes[3],newnodes[7])
+		graph.add_arc(newnodes[7],newnodes[8])
+		self.graph=graph
 		
-		xml.append('\t<arc begin="'+str(newnodes[1][2])+'" end="'+str(newnodes[2][2])+'" isPushBackRoute="0" name="" />\n')
-		xml.append('\t<arc begin="'+str(newnodes[2][2])+'" end="'+str(newnodes[1][2])+'" isPushBackRoute="0" name="" />\n')
-				
-		xml.append('\t<arc begin="'+str(newnodes[2][2])+'" end="'+str(subnodes[0][2])+'" isPushBackRoute="0" name="" />\n')
-		xml.append('\t<arc begin="'+str(subnodes[0][2])+'" end="'+str(newnodes[2][2])+'" isPushBackRoute="0" name="" />\n')
+	
+	def write_airport_850(self,out):
+		if self.graph==None:
+			self.layout_airport_850()
+		self.write_network(out)
 		
-		pp=0
-		for s  in subnodes:
-			if pp > len(subnodes)-2:
+	
+	def read_rows(self,rows,end):
+		# content holds the airport record, header first. Its lines before end, up to the
+		# blank line closing the record, are split once and handed to their row handler
+		content=self.apt_content
+		self.frequencies=[]
+		for num in xrange(1,min(end,len(content))):
+			line=content[num]
+			if line=='\n' or line=='\r\n':
 				break
-			xml.append('\t<arc begin="'+str(s[2])+'" end="'+str(subnodes[pp+1][2])+'" isPushBackRoute="0" name="" />\n')
-			xml.append('\t<arc begin="'+str(subnodes[pp+1][2])+'" end="'+str(s[2])+'" isPushBackRoute="0" name="" />\n')
-			pp+=1
-		
-		
+			dispatch_row(rows,self,num,line)
+		self.apt_content=None
 		
-		xml.append('\t<arc begin="'+str(newnodes[3][2])+'" end="'+str(subnodes[-1][2])+'" isPushBackRoute="0" name="" />\n')
-		xml.append('\t<arc begin="'+str(subnodes[-1][2])+'" end="'+str(newnodes[3][2])+'" isPushBackRoute="0" name="" />\n')
+	
+	def read_frequency(self,num,tokens,line):
+		if num>=4 and is_frequency(tokens):
+			self.frequencies.append(parse_frequency(tokens))
+			
+	
+	def write_frequencies(self,out):
+		for f in self.frequencies:
+			tag=FREQUENCY_TAGS.get(f.code)
+			if tag!=None:
+				out.write(FREQUENCY_TEMPLATE % (tag,f.freq,tag))
 				
-		xml.append('\t<arc begin="'+str(newnodes[3][2])+'" end="'+str(newnodes[4][2])+'" isPushBackRoute="0" name="" />\n')
-		xml.append('\t<arc begin="'+str(newnodes[4][2])+'" end="'+str(newnodes[3][2])+'" isPushBackRoute="0" name="" />\n')
-		
-		xml.append('\t<arc begin="'+str(newnodes[4][2])+'" end="'+str(newnodes[5][2])+'" isPushBackRoute="0" name="" />\n')
-		xml.append('\t<arc begin="'+str(newnodes[5][2])+'" end="'+str(newnodes[4][2])+'" isPushBackRoute="0" name="" />\n')
-		
-		xml.append('\t<arc begin="'+str(newnodes[6][2])+'" end="'+str(newnodes[5][2])+'" isPushBackRoute="0" name="" />\n')
-		xml.append('\t<arc begin="'+str(newnodes[5][2])+'" end="'+str(newnodes[6][2])+'" isPushBackRoute="0" name="" />\n')
-		
-		xml.append('\t<arc begin="'+str(newnodes[3][2])+'" end="'+str(newnodes[7][2])+'" isPushBackRoute="0" name="" />\n')
-		xml.append('\t<arc begin="'+str(newnodes[7][2])+'" end="'+str(newnodes[3][2])+'" isPushBackRoute="0" name="" />\n')
-		
-		xml.append('\t<arc begin="'+str(newnodes[7][2])+'" end="'+str(newnodes[8][2])+'" isPushBackRoute="0" name="" />\n')
-		xml.append('\t<arc begin="'+str(newnodes[8][2])+'" end="'+str(newnodes[7][2])+'" isPushBackRoute="0" name="" />\n')
-		
-
-		
-		xml.append('</TaxiWaySegments>\n</groundnet>\n')
+		out.write('</frequencies>\n')
 		
-		self.save_network(apt,xml,850)
-
-
-	def save_network(self,apt,xml,version=810):
-		buf="".join(xml)
-		dir_path=''
-		output_dir='output'
-		if version==850:
-			output_dir='output850'
-		if self.save_tree==True:
-			if len(apt)==4 or len(apt)==3:
-				dir_path=os.path.join(os.getcwd(),output_dir,'Airports',apt[0],apt[1],apt[2])
-			else:
-				print "Airport ICAO has "+len(apt)+" letters, skipping"
-				return
-			if os.path.exists(dir_path)==False:
-				try:
-					os.makedirs(dir_path,0755)
-				except:
-					pass
-		else:
-			dir_path=os.path.join(os.getcwd(),output_dir)
-		path=os.path.join(dir_path,apt+'.groundnet.xml')
-		fw=open(path,'wb')
-		fw.write(buf)
-		fw.close()
+	
+	def warn(self,message):
+		print "warning:",self.apt,message
+		self.warnings.append(message)
 		
 	
 	def find_midpoint(self,lat1,lat2,lon1,lon2,index):
-		if lon1>lon2:
+		if abs(lon1-lon2)>180:
+			lon=midpoint_lon(lon1,lon2)
+		elif lon1>lon2:
 			lon=(lon1-lon2)/2 + lon2
 		else:
 			lon=(lon2-lon1)/2 + lon1
@@ -671,74 +3056,180 @@ class Parser(multiprocessing.Process):
 			lat=(lat1-lat2)/2 + lat2
 		else:
 			lat=(lat2-lat1)/2 + lat1
-		return (lat,lon,index)
-
-
-	def gen_parking(self,lat,lon,index,heading):
-		coord=self.convert_coord(lat,lon)
-		buf='''
-		<Parking index="'''+str(index)+'''"
-			 type="gate"
-			 name="Gate"
-			 number="'''+str(index+1)+'''"
-			 lat="'''+coord[0]+'''"
-			 lon="'''+coord[1]+'''"
-			 heading="'''+str(heading)+'''"
-			 radius="28"
-			 airlineCodes="" />'''
-		return buf
-				
-			
-	def convert_coord(self,lat,lon):
-		coord=[]
-		str_lat=''
-		str_lon=''
-		if lat>0:
-			str_lat+='N'
-		else:
-			str_lat+='S'
-		if lon>0:
-			str_lon+='E'
-		else:
-			str_lon+='W'
-		mod_lat=math.modf(lat)
-		lat=int(math.fabs(mod_lat[1]))
-		lat_deg=math.fabs(mod_lat[0]) *60
-		str_lat+=str(lat)+' '+str(lat_deg)
-		
-		mod_lon=math.modf(lon)
-		lon=int(math.fabs(mod_lon[1]))
-		lon_deg=math.fabs(mod_lon[0]) *60
-		str_lon+=str(lon)+' '+str(lon_deg)
-		coord.append(str_lat)
-		coord.append(str_lon)
-		return coord
+		return TaxiNode(lat,lon,index)
 		
+	
+	ROWS_810=dict.fromkeys(FREQUENCY_ROWS,read_frequency)
+	ROWS_810[RUNWAY_810_ROW]=read_runway_810
+	ROWS_850=dict.fromkeys(FREQUENCY_ROWS,read_frequency)
+	ROWS_850.update(dict.fromkeys(NODE_850_ROWS,read_node_850))
+	ROWS_850.update({PAVEMENT_850_ROW:read_pavement_850,RUNWAY_850_ROW:read_runway_850})
+
 
 
+def region_option(options):
+	if options.bbox:
+		return bbox_region(options.bbox)
+	elif options.tile:
+		return tile_region(options.tile)
+	elif options.near:
+		return near_region(options.near)
+	return None
+	
+	
 if __name__ == "__main__":
-	if len(sys.argv) <2:
-		print 'Usage: groundnet.py all | airport <ICAO> [850]'
+	optparser=optparse.OptionParser(usage='groundnet.py all [850|both] | airport <ICAO> [850] | batch [850|both] [ICAO ...] | sweep [850|both] [ICAO ...] | merge [850|both] N | serve [850|both]')
+	optparser.add_option('-j','--workers',type='int',help='number of worker processes for all, defaults to the number of CPUs')
+	optparser.add_option('--chunk',type='int',help='number of airports sent to a worker at once')
+	optparser.add_option('--stats',metavar='FILE',help='write stage times, counts, latency percentiles and failures to FILE as JSON')
+	optparser.add_option('--stream',action='store_true',help='for all, generate while reading the data files with bounded memory')
+	optparser.add_option('--port',type='int',default=SERVE_PORT,help='localhost port of serve, defaults to %d' % SERVE_PORT)
+	optparser.add_option('--socket',metavar='PATH',help='serve on a unix socket instead of a port')
+	optparser.add_option('--cache',type='int',default=256,help='number of generated airports kept in memory by serve')
+	optparser.add_option('--list',metavar='FILE',help='for batch, generate the ICAO codes listed in FILE, - reads stdin')
+	optparser.add_option('--match',metavar='REGEX',help='for batch, generate the airports whose ICAO code starts with a match of REGEX')
+	optparser.add_option('--bbox',metavar='W,S,E,N',help='for all, only airports inside this box of degrees')
+	optparser.add_option('--tile',metavar='INDEX',help='for all, only airports inside this scenery tile')
+	optparser.add_option('--near',metavar='LAT,LON,KM',help='for all, only airports within KM kilometers of LAT,LON')
+	optparser.add_option('--routes',action='store_true',help='also write the shortest routes from every parking to every hold point as <ICAO>.routes.json')
+	optparser.add_option('--profile',metavar='DIR',help='write a cProfile file for every worker process to DIR')
+	optparser.add_option('--shard',metavar='K/N',help='for all, only generate the airports of shard K out of N, into shards/K-of-N')
+	optparser.add_option('--spacing',metavar='M,M,...',help='for sweep, parking spacings in meters, comma separated')
+	optparser.add_option('--distance',metavar='M,M,...',help='for sweep, distances in meters between taxiway and parkings, comma separated')
+	options,args=optparser.parse_args()
+	if len(args) <1:
+		print 'Usage: groundnet.py all [850|both] | airport <ICAO> [850] | batch [850|both] [ICAO ...] | sweep [850|both] [ICAO ...] | merge [850|both] N | serve [850|both]'
 		sys.exit()
 	else:
-		if sys.argv[1]=='airport':
-			if len(sys.argv) <3:
+		if args[0]=='airport':
+			if len(args) <2:
 				print 'Usage: groundnet.py airport <ICAO> [850]'
 				sys.exit()
-			elif len(sys.argv) == 4 and sys.argv[3]== '850':
-				apt=sys.argv[2]
+			elif len(args) == 3 and args[2]== '850':
+				apt=args[1]
 				parser=Groundnet(850)
+				parser.routes=options.routes
 				parser.parse_airport(apt)
 			else:
-				apt=sys.argv[2]
-				parser=Groundnet()
+				apt=args[1]
+				parser=Groundnet(810)
+				parser.routes=options.routes
 				parser.parse_airport(apt)
-		elif sys.argv[1]=='all':
-			if len(sys.argv) == 3 and sys.argv[2]== '850':
+			if options.stats:
+				parser.stats.save(options.stats)
+		elif args[0]=='all':
+			if len(args) == 2 and args[1]== '850':
 				parser=Groundnet(850)
+			elif len(args) == 2 and args[1]== 'both':
+				parser=Groundnet((810,850))
+			else:
+				parser=Groundnet(810)
+			parser.routes=options.routes
+			parser.workers=options.workers
+			parser.chunk_size=options.chunk
+			parser.profile_dir=options.profile
+			parser.region=region_option(options)
+			if options.shard:
+				parser.shard=shard_option(options.shard)
+				parser.output_root=shard_root(*parser.shard)
+			if options.stream and options.routes:
+				print '--routes is not supported with --stream'
+				sys.exit()
+			if options.stream:
+				parser.stream_all()
 			else:
-				parser=Groundnet()
+				parser.parse_all()
+			if options.stats:
+				parser.stats.save(options.stats)
+		elif args[0]=='batch':
+			version=810
+			names=args[1:]
+			if len(args) > 1 and args[1]== '850':
+				version=850
+				names=args[2:]
+			elif len(args) > 1 and args[1]== 'both':
+				version=(810,850)
+				names=args[2:]
+			names=[a.upper() for a in names]
+			if options.list:
+				names.extend(read_names(options.list))
+			if len(names)==0 and options.match==None:
+				print 'Usage: groundnet.py batch [850|both] [ICAO ...] [--list FILE|-] [--match REGEX]'
+				sys.exit()
+			parser=Groundnet(version)
+			parser.routes=options.routes
+			parser.workers=options.workers
+			parser.chunk_size=options.chunk
+			parser.profile_dir=options.profile
+			parser.region=region_option(options)
+			parser.select_airports(names,options.match)
 			parser.parse_all()
+			if options.stats:
+				parser.stats.save(options.stats)
+		elif args[0]=='sweep':
+			version=810
+			names=args[1:]
+			if len(args) > 1 and args[1]== '850':
+				version=850
+				names=args[2:]
+			elif len(args) > 1 and args[1]== 'both':
+				version=(810,850)
+				names=args[2:]
+			names=[a.upper() for a in names]
+			if options.list:
+				names.extend(read_names(options.list))
+			pattern=options.match
+			if len(names)==0 and pattern==None:
+				# no selection sweeps every airport fitting the layout, or those of the region
+				pattern=''
+			parser=Groundnet(version)
+			parser.routes=options.routes
+			spacings=[parser.park_spacing]
+			distances=[parser.park_distance]
+			if options.spacing:
+				spacings=float_list(options.spacing)
+			if options.distance:
+				distances=float_list(options.distance)
+			narrow=[s for s in spacings if s<2*PARKING_RADIUS]
+			if len(narrow)>0:
+				# every network of such a variant would fail validation
+				print 'Parkings closer than %g m overlap, spacing %s is too small' % (2*PARKING_RADIUS,','.join(['%g' % s for s in narrow]))
+				sys.exit(1)
+			parser.workers=options.workers
+			parser.chunk_size=options.chunk
+			parser.region=region_option(options)
+			parser.select_airports(names,pattern)
+			parser.sweep([(s,d) for s in spacings for d in distances])
+			if options.stats:
+				parser.stats.save(options.stats)
+		elif args[0]=='merge':
+			version=810
+			count=args[1:]
+			if len(args) > 1 and args[1]== '850':
+				version=850
+				count=args[2:]
+			elif len(args) > 1 and args[1]== 'both':
+				version=(810,850)
+				count=args[2:]
+			if len(count)!=1:
+				print 'Usage: groundnet.py merge [850|both] N'
+				sys.exit()
+			parser=Groundnet(version)
+			parser.routes=options.routes
+			parser.region=region_option(options)
+			if parser.merge_shards(int(count[0]))==False:
+				sys.exit(1)
+		elif args[0]=='serve':
+			if len(args) == 2 and args[1]== '850':
+				parser=Groundnet(850)
+			elif len(args) == 2 and args[1]== 'both':
+				parser=Groundnet((810,850))
+			else:
+				parser=Groundnet(810)
+			parser.workers=options.workers
+			parser.serve(options.socket or ('127.0.0.1',options.port),options.cache)
+			if options.stats:
+				parser.stats.save(options.stats)
 		else:
-			print 'Usage: groundnet.py all | airport <ICAO> [850]'
+			print 'Usage: groundnet.py all [850|both] | airport <ICAO> [850] | batch [850|both] [ICAO ...] | sweep [850|both] [ICAO ...] | merge [850|both] N | serve [850|both]'
 			sys.exit()